@@ -0,0 +1,125 @@
+"""
+测量不同线程配置下Seq2Seq的训练step时间和translate延迟，保存本机最快的配置。
+
+    python autotune_threads.py --workload train --layers 1
+    python autotune_threads.py --workload translate --layers 1 --jobs 2
+
+inter-op线程数在一个进程里只能设置一次，所以每个配置在单独的子进程里测量(通过
+SEQ2SEQ_THREADS环境变量传入)。--jobs k 时同一配置同时启动k个子进程，模拟一台机器上
+并行跑k个任务，每个进程的线程数不超过 CPU核数/k。
+结果保存在 thread_settings.json，训练脚本、translation_server.py等启动时自动应用。
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import model_loader
+import thread_settings
+
+
+def candidates(jobs):
+    cores = os.cpu_count() or 1
+    max_threads = max(1, cores // jobs)
+    threads = sorted({2**i for i in range(max_threads.bit_length())} | {max_threads})
+    interops = [n for n in (1, 2, 4) if n <= max_threads]
+    return [(n, m) for n in threads for m in interops]
+
+
+def benchmark_train(script, steps, warmup):
+    """返回每个训练step的秒数"""
+    return model_loader.train_step_seconds(script, script.model, script.optimizer, steps, warmup)
+
+
+def benchmark_translate(script, num_sentences, warmup):
+    """返回每句话的平均翻译秒数"""
+    import torch
+
+    if os.path.exists(script.MODEL_PATH):
+        _, model = model_loader.load_model(script.N_LAYERS)
+    else:
+        # 没有训练好的模型时用随机权重，译文长度可能和真实模型不同
+        model = script.model
+        model.eval()
+    sentences = script.en_data[-num_sentences:]
+    samples = [model_loader.encode_source(script, sentence, device=model.device) for sentence in sentences]
+    inputs = iter(samples[:warmup] + samples)
+    with torch.no_grad():
+        return model_loader.time_calls(lambda: script.translate(model, next(inputs), script.id2ch),
+                                       len(samples), warmup, model.device)
+
+
+def run_worker(args):
+    # 在做任何torch计算之前按SEQ2SEQ_THREADS设置线程数
+    thread_settings.apply(args.workload, args.jobs)
+    script = model_loader.load_script(args.layers)
+    if args.workload == "train":
+        seconds = benchmark_train(script, args.steps, args.warmup)
+    else:
+        seconds = benchmark_translate(script, args.num_sentences, args.warmup)
+    # 最后一行是结果，前面是脚本加载数据时的输出
+    print(json.dumps({"seconds": seconds}))
+
+
+def measure(args, num_threads, interop_threads):
+    """同时启动args.jobs个子进程，返回它们的平均秒数"""
+    env = dict(os.environ, **{thread_settings.ENV_OVERRIDE: "%d,%d" % (num_threads, interop_threads)})
+    command = [sys.executable, os.path.abspath(__file__), "--worker",
+               "--workload", args.workload, "--layers", str(args.layers), "--jobs", str(args.jobs),
+               "--steps", str(args.steps), "--num_sentences", str(args.num_sentences),
+               "--warmup", str(args.warmup)]
+    procs = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True) for _ in range(args.jobs)]
+    results = []
+    for proc in procs:
+        stdout, _ = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError("worker failed with threads=%d interop=%d" % (num_threads, interop_threads))
+        results.append(json.loads(stdout.strip().split('\n')[-1])["seconds"])
+    return sum(results) / len(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="thread configuration autotuner for Seq2Seq")
+    parser.add_argument("--workload", choices=["train", "translate"], default="train")
+    parser.add_argument("--layers", type=int, default=1, choices=[1, 2, 3])
+    parser.add_argument("--jobs", type=int, default=1, help="同一台机器上同时运行的任务数")
+    parser.add_argument("--steps", type=int, default=20, help="计时的训练step数")
+    parser.add_argument("--num_sentences", type=int, default=100, help="计时的翻译句子数")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--no_save", action="store_true")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    unit = "s/step" if args.workload == "train" else "s/sentence"
+    columns = [("threads", "r", "%d"), ("interop", "r", "%d"), (unit, "r", "%.4f")]
+    results = []
+    print(model_loader.markdown_table(columns, []), end="")
+    for num_threads, interop_threads in candidates(args.jobs):
+        seconds = measure(args, num_threads, interop_threads)
+        results.append((seconds, num_threads, interop_threads))
+        print(model_loader.markdown_row(columns, (num_threads, interop_threads, seconds)))
+
+    seconds, num_threads, interop_threads = min(results)
+    print(f'Best for {args.workload} with {args.jobs} job(s) on {thread_settings.host_key()}: '
+          f'threads={num_threads} interop={interop_threads} ({seconds:.4f} {unit})')
+    if not args.no_save:
+        thread_settings.save(args.workload, args.jobs, {
+            "num_threads": num_threads,
+            "interop_threads": interop_threads,
+            "seconds": seconds,
+            "unit": unit,
+            "layers": args.layers,
+            "cpu_count": os.cpu_count(),
+            "results": [{"num_threads": n, "interop_threads": m, "seconds": s} for s, n, m in results],
+        })
+        print("Saved to", thread_settings.SETTINGS_FILE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Corpus BLEU (Papineni et al. 2002)，用于比较不同推理后端/配置的翻译质量。
+默认按空格切词；字符级比较可以传 tokenize=list。
+"""
+
+import collections
+import math
+
+
+def ngram_stats(reference, hypothesis, max_n=4):
+    """返回 (各阶n-gram匹配数, 各阶n-gram总数)，参数为token列表"""
+    matches = [0] * max_n
+    possible = [0] * max_n
+    for n in range(1, max_n + 1):
+        ref_counts = collections.Counter(tuple(reference[i:i+n]) for i in range(len(reference) - n + 1))
+        hyp_counts = collections.Counter(tuple(hypothesis[i:i+n]) for i in range(len(hypothesis) - n + 1))
+        matches[n-1] = sum(min(count, ref_counts[ngram]) for ngram, count in hyp_counts.items())
+        possible[n-1] = max(len(hypothesis) - n + 1, 0)
+    return matches, possible
+
+
+def corpus_bleu(references, hypotheses, max_n=4, tokenize=str.split):
+    """references/hypotheses 为字符串列表，返回 0~100 的BLEU"""
+    matches = [0] * max_n
+    possible = [0] * max_n
+    ref_len = hyp_len = 0
+    for ref, hyp in zip(references, hypotheses):
+        ref, hyp = tokenize(ref), tokenize(hyp)
+        ref_len += len(ref)
+        hyp_len += len(hyp)
+        m, p = ngram_stats(ref, hyp, max_n)
+        matches = [a + b for a, b in zip(matches, m)]
+        possible = [a + b for a, b in zip(possible, p)]
+    if hyp_len == 0 or min(matches) == 0:
+        return 0.
+    log_precision = sum(math.log(m / p) for m, p in zip(matches, possible)) / max_n
+    brevity_penalty = min(1., math.exp(1 - ref_len / hyp_len))
+    return 100 * brevity_penalty * math.exp(log_precision)
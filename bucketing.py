@@ -0,0 +1,275 @@
+"""Derives bucket_upper_bound / bucket_batch_limit from a corpus.
+
+Scans the length histogram of a text corpus, picks bucket upper bounds that
+minimize padding, and gives every bucket as many examples as fit in a target
+number of tokens per batch (capped by a memory budget). The result is written
+to a JSON file that codelab.RNMTModel picks up for its Train/Test params:
+
+  python bucketing.py --input=/tmp/punctuator_data/train.txt --split=train \
+      --output=/tmp/punctuator_data/buckets.json --tokens_per_batch=6144
+
+Lengths are measured in --unit. 'wordpieces' runs the tokenizer of
+codelab.RNMTModel's --split input params and takes max(source, target) per
+example, exactly like PunctuatorInput's bucket key; it needs lingvo and the
+vocab. 'words' and 'chars' are quick approximations: real batches are padded in
+wordpieces, so their batch limits can exceed the token budget, and the largest
+bound is pinned to --max_length so that the approximation does not silently
+drop examples the input generator would keep.
+
+With --compare, the derived buckets are benchmarked against the given
+hand-tuned ones by simulating the bucketed input on the same corpus.
+"""
+
+import argparse
+import bisect
+import collections
+import json
+import os
+
+
+def ExampleLength(line, unit='words'):
+  """Approximate length of one example in words or chars."""
+  if unit == 'chars':
+    # Character-level models also append <eos>.
+    return len(line) + 1
+  return len(line.split()) + 1
+
+
+def WordpieceLengths(lines, split='train'):
+  """Bucket keys of `lines` as PunctuatorInput computes them for `split`.
+
+  Uses the tokenizer and vocab of codelab.RNMTModel's Train or Test params. The
+  max lengths are lifted so that long examples are measured, not truncated.
+  """
+  import codelab  # pylint: disable=g-import-not-at-top
+  model = codelab.RNMTModel()
+  p = model.Train() if split == 'train' else model.Test()
+  p.source_max_length = p.target_max_length = 1 << 16
+  return p.Instantiate().BucketKeys(lines)
+
+
+def LengthHistogram(lines, unit='words'):
+  """Returns a Counter mapping example length to number of examples."""
+  return collections.Counter(ExampleLength(line, unit) for line in lines)
+
+
+def DeriveBucketBounds(histogram, num_buckets, max_length=None):
+  """Picks upper bounds that minimize the padding to the bucket bound.
+
+  Dynamic programming over the distinct lengths: the cost of a bucket is the
+  number of pad tokens needed to bring all of its examples to its bound.
+
+  Args:
+    histogram: Counter of example length -> count.
+    num_buckets: maximum number of buckets.
+    max_length: examples longer than this are discarded, like examples longer
+      than the largest bucket in the input generator.
+
+  Returns:
+    The sorted list of bucket upper bounds.
+  """
+  lengths = sorted(l for l in histogram if max_length is None or l <= max_length)
+  if not lengths:
+    raise ValueError('No examples shorter than max_length=%s' % max_length)
+  counts = [histogram[l] for l in lengths]
+  # Prefix sums of counts and of tokens, to get bucket costs in O(1).
+  count_sum = [0]
+  token_sum = [0]
+  for l, c in zip(lengths, counts):
+    count_sum.append(count_sum[-1] + c)
+    token_sum.append(token_sum[-1] + l * c)
+
+  def Cost(a, b):
+    # Bucket holding lengths[a:b], padded to lengths[b - 1].
+    return (lengths[b - 1] * (count_sum[b] - count_sum[a]) -
+            (token_sum[b] - token_sum[a]))
+
+  k_max = min(num_buckets, len(lengths))
+  inf = float('inf')
+  n = len(lengths)
+  # best[k][b]: min cost of covering lengths[:b] with k buckets.
+  best = [[inf] * (n + 1) for _ in range(k_max + 1)]
+  split = [[0] * (n + 1) for _ in range(k_max + 1)]
+  best[0][0] = 0
+  for k in range(1, k_max + 1):
+    for b in range(1, n + 1):
+      for a in range(k - 1, b):
+        cost = best[k - 1][a] + Cost(a, b)
+        if cost < best[k][b]:
+          best[k][b] = cost
+          split[k][b] = a
+  bounds = []
+  b = n
+  for k in range(k_max, 0, -1):
+    bounds.append(lengths[b - 1])
+    b = split[k][b]
+  return sorted(set(bounds))
+
+
+def DeriveBatchLimits(bounds,
+                      tokens_per_batch,
+                      max_batch_size=512,
+                      memory_budget_mb=None,
+                      bytes_per_token=None,
+                      batch_multiple=8):
+  """Batch limit per bucket so that limit * bound stays within the budget.
+
+  Args:
+    bounds: bucket upper bounds.
+    tokens_per_batch: target number of (padded) tokens per batch.
+    max_batch_size: upper limit on the number of examples per batch.
+    memory_budget_mb: if set together with bytes_per_token, caps the tokens per
+      batch to what fits in this much activation memory.
+    bytes_per_token: activation memory per token of the model.
+    batch_multiple: limits are rounded down to a multiple of this when larger.
+
+  Returns:
+    A list with one batch limit per bucket.
+  """
+  if memory_budget_mb and bytes_per_token:
+    tokens_per_batch = min(tokens_per_batch,
+                           int(memory_budget_mb * 2**20 / bytes_per_token))
+  limits = []
+  for bound in bounds:
+    limit = min(max_batch_size, max(1, tokens_per_batch // bound))
+    if limit >= batch_multiple:
+      limit -= limit % batch_multiple
+    limits.append(limit)
+  return limits
+
+
+def SimulateBatches(lengths, bounds, limits):
+  """Simulates length bucketing and returns utilization statistics.
+
+  Examples go to the first bucket whose bound fits them and a bucket emits a
+  batch once it holds its limit, as in GenericInput. Batches are padded to
+  their longest example (dynamic padding); the capacity of a batch is what its
+  bucket is provisioned for, limit * bound.
+  """
+  pending = [[] for _ in bounds]
+  batches = []
+  dropped = 0
+  for length in lengths:
+    i = bisect.bisect_left(bounds, length)
+    if i == len(bounds):
+      dropped += 1
+      continue
+    pending[i].append(length)
+    if len(pending[i]) == limits[i]:
+      batches.append((i, pending[i]))
+      pending[i] = []
+  batches.extend((i, batch) for i, batch in enumerate(pending) if batch)
+
+  real = sum(sum(batch) for _, batch in batches)
+  padded = sum(len(batch) * max(batch) for _, batch in batches)
+  capacity = sum(limits[i] * bounds[i] for i, _ in batches)
+  return {
+      'examples': len(lengths) - dropped,
+      'dropped': dropped,
+      'batches': len(batches),
+      'tokens_per_batch': real / max(1, len(batches)),
+      'padding_efficiency': real / max(1, padded),
+      'capacity_utilization': real / max(1, capacity),
+      'max_batch_tokens': max(l * b for l, b in zip(limits, bounds)),
+  }
+
+
+def LoadBuckets(path, split):
+  """Returns (bucket_upper_bound, bucket_batch_limit) for `split`, or None."""
+  if not path or not os.path.exists(path):
+    return None
+  with open(path) as f:
+    buckets = json.load(f)
+  if split not in buckets:
+    return None
+  return (buckets[split]['bucket_upper_bound'],
+          buckets[split]['bucket_batch_limit'])
+
+
+def SaveBuckets(path, split, bounds, limits):
+  """Writes the buckets of `split` to `path`, keeping the other splits."""
+  buckets = {}
+  if os.path.exists(path):
+    with open(path) as f:
+      buckets = json.load(f)
+  buckets[split] = {'bucket_upper_bound': bounds, 'bucket_batch_limit': limits}
+  with open(path, 'w') as f:
+    json.dump(buckets, f, indent=2, sort_keys=True)
+
+
+def _IntList(value):
+  return [int(v) for v in value.split(',')]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--input', required=True, help='Text corpus.')
+  parser.add_argument(
+      '--column', type=int, default=None,
+      help='For tab separated corpora such as newdata, the column to measure. '
+      'By default the longest column of each line is used.')
+  parser.add_argument(
+      '--unit', choices=['wordpieces', 'words', 'chars'], default='words',
+      help='wordpieces: exact, as PunctuatorInput buckets. words/chars: fast '
+      'approximations; the largest bound is pinned to --max_length.')
+  parser.add_argument('--num_buckets', type=int, default=5)
+  parser.add_argument('--max_length', type=int, default=120)
+  parser.add_argument('--tokens_per_batch', type=int, default=6144)
+  parser.add_argument('--max_batch_size', type=int, default=512)
+  parser.add_argument('--memory_budget_mb', type=float, default=None)
+  parser.add_argument('--bytes_per_token', type=float, default=None)
+  parser.add_argument('--output', default=None, help='JSON file to update.')
+  parser.add_argument('--split', default='train')
+  parser.add_argument(
+      '--compare', action='store_true',
+      help='Benchmark against --baseline_bounds/--baseline_limits.')
+  parser.add_argument('--baseline_bounds', type=_IntList,
+                      default=[10, 20, 30, 60, 120])
+  parser.add_argument('--baseline_limits', type=_IntList,
+                      default=[512, 256, 160, 80, 40])
+  args = parser.parse_args()
+
+  examples = []
+  with open(args.input, encoding='utf-8') as f:
+    for line in f:
+      columns = line.rstrip('\n').split('\t')
+      if args.column is not None:
+        columns = [columns[args.column]]
+      examples.append(columns)
+  if args.unit == 'wordpieces':
+    keys = iter(WordpieceLengths([c for cs in examples for c in cs],
+                                 args.split))
+    lengths = [max(next(keys) for _ in cs) for cs in examples]
+  else:
+    lengths = [max(ExampleLength(c, args.unit) for c in cs) for cs in examples]
+
+  histogram = collections.Counter(lengths)
+  bounds = DeriveBucketBounds(histogram, args.num_buckets, args.max_length)
+  if args.unit != 'wordpieces' and bounds[-1] < args.max_length:
+    # Approximate lengths undercount wordpieces; keep everything the input
+    # generator would keep.
+    bounds[-1] = args.max_length
+  limits = DeriveBatchLimits(bounds, args.tokens_per_batch,
+                             args.max_batch_size, args.memory_budget_mb,
+                             args.bytes_per_token)
+  print('bucket_upper_bound = %s' % bounds)
+  print('bucket_batch_limit = %s' % limits)
+  if args.output:
+    SaveBuckets(args.output, args.split, bounds, limits)
+    print('Wrote %s buckets to %s' % (args.split, args.output))
+
+  if args.compare:
+    rows = [('hand-tuned', SimulateBatches(lengths, args.baseline_bounds,
+                                           args.baseline_limits)),
+            ('derived', SimulateBatches(lengths, bounds, limits))]
+    keys = ['examples', 'dropped', 'batches', 'tokens_per_batch',
+            'padding_efficiency', 'capacity_utilization', 'max_batch_tokens']
+    print('%-22s' % '' + ''.join('%14s' % name for name, _ in rows))
+    for key in keys:
+      print('%-22s' % key + ''.join(
+          '%14.3f' % stats[key] if isinstance(stats[key], float) else
+          '%14d' % stats[key] for _, stats in rows))
+
+
+if __name__ == '__main__':
+  main()
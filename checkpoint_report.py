@@ -0,0 +1,108 @@
+"""
+比较激活检查点开关时训练的峰值内存和速度。
+
+    python checkpoint_report.py --layers 1,2,3 --batch_sizes 32,64 --checkpoint_every 8
+
+每个 (层数, batch大小, 是否检查点) 在单独的子进程里训练 --steps 步，报告每步时间、
+句子/秒和训练时的峰值内存(CPU为进程的VmHWM减去开始计时前的RSS，GPU为max_memory_allocated)。
+检查点模式同时对encoder做检查点，decoder每 --checkpoint_every 步一段。
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import model_loader
+
+COLUMNS = [("layers", "r", "%d"), ("batch", "r", "%d"), ("checkpoint", "c", "%s"), ("step time (s)", "r", "%.3f"),
+           ("sentences/s", "r", "%.1f"), ("peak activation memory (MB)", "r", "%.0f")]
+
+
+def _read_status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def _reset_peak_rss():
+    # 写5到clear_refs会把VmHWM重置为当前的RSS
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def run_worker(args):
+    import torch
+    import torch.optim as optim
+
+    script = model_loader.load_script(args.layers)
+    enc = script.Encoder(script.INPUT_DIM, script.ENC_EMB_DIM, script.HID_DIM, script.N_LAYERS,
+                         script.ENC_DROPOUT, script.bidirectional)
+    dec = script.AttnDecoder(script.OUTPUT_DIM, script.DEC_EMB_DIM, script.HID_DIM, script.N_LAYERS,
+                             script.DEC_DROPOUT, script.bidirectional, script.attn_method)
+    model = script.Seq2Seq(enc, dec, script.device, basic_dict=script.basic_dict,
+                           checkpoint_every=args.checkpoint_every,
+                           checkpoint_encoder=args.checkpoint_every > 0).to(script.device)
+    optimizer = optim.Adam(model.parameters(), lr=script.LEARNING_RATE)
+    cuda = script.device.type == "cuda"
+    baseline_kb = 0
+
+    def reset_peak():
+        # 预热一步之后再重置，优化器状态等常驻内存算在基线里
+        nonlocal baseline_kb
+        if cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            baseline_kb = torch.cuda.memory_allocated() // 1024
+        else:
+            _reset_peak_rss()
+            baseline_kb = _read_status_kb("VmRSS")
+
+    seconds = model_loader.train_step_seconds(script, model, optimizer, args.steps, warmup=1,
+                                              batch_size=args.batch_size, before_timing=reset_peak)
+    peak_kb = torch.cuda.max_memory_allocated() // 1024 if cuda else _read_status_kb("VmHWM")
+    print(json.dumps({"seconds": seconds, "peak_mb": (peak_kb - baseline_kb) / 1024}))
+
+
+def measure(args, layers, batch_size, checkpoint_every):
+    command = [sys.executable, os.path.abspath(__file__), "--worker",
+               "--layers", str(layers), "--batch_sizes", str(batch_size),
+               "--checkpoint_every", str(checkpoint_every), "--steps", str(args.steps)]
+    stdout = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+    # 最后一行是结果，前面是脚本加载数据时的输出
+    return json.loads(stdout.strip().split('\n')[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="activation checkpointing memory/throughput report")
+    parser.add_argument("--layers", default="1,2,3")
+    parser.add_argument("--batch_sizes", default="32,64")
+    parser.add_argument("--checkpoint_every", type=int, default=8, help="decoder每多少步一段")
+    parser.add_argument("--steps", type=int, default=10, help="计时的训练step数")
+    parser.add_argument("--output", default=None, help="把markdown表格也写到这个文件")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.layers, args.batch_size = int(args.layers), int(args.batch_sizes)
+        run_worker(args)
+        return
+
+    rows = []
+    for layers in map(int, args.layers.split(',')):
+        for batch_size in map(int, args.batch_sizes.split(',')):
+            for checkpoint_every in (0, args.checkpoint_every):
+                result = measure(args, layers, batch_size, checkpoint_every)
+                mode = 'every %d' % checkpoint_every if checkpoint_every else 'off'
+                rows.append((layers, batch_size, mode, result["seconds"],
+                             batch_size / result["seconds"], result["peak_mb"]))
+                print(model_loader.markdown_row(COLUMNS, rows[-1]))
+    print()
+    model_loader.write_report(model_loader.markdown_table(COLUMNS, rows), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,90 @@
 import os
 from lingvo import model_registry
-import lingvo.compat as tf
 from lingvo.core import base_model_params
-from lingvo.tasks.mt import base_config
-from lingvo.tasks.punctuator import input_generator
-from lingvo.tasks.punctuator import model
+
+import codelab_params
+
+# The MT task and config modules, the input generator and bucketing are
+# imported inside the methods that need them, and paths are resolved on first
+# use. model_registry and base_model_params are needed to define and register
+# the params classes, and they already import lingvo.compat (and so
+# TensorFlow), so importing this module still loads TensorFlow. Data locations
+# and the architecture of every variant come from codelab_params, which lists
+# them without importing lingvo.
+
+
+def _FileParallelism(file_pattern, max_parallelism=16):
+  """One reader per input shard, up to `max_parallelism`."""
+  import lingvo.compat as tf  # pylint: disable=g-import-not-at-top
+  num_files = len(tf.io.gfile.glob(file_pattern.split(':', 1)[-1]))
+  return max(1, min(num_files, max_parallelism))
+
+
+def _ShareEmbeddings(p):
+  """Ties the decoder embedding to the softmax and shares it with the encoder.
+
+  Uses a lingvo SharedSoftmaxLayer through the `shared_emb` params of the
+  encoder and decoder.
+
+  Args:
+    p: the task params, modified in place.
+
+  Returns:
+    Whether the embeddings are shared. False when the installed lingvo's RNMT
+    encoder/decoder have no `shared_emb` param; p is then left untouched.
+  """
+  # pylint: disable=g-import-not-at-top
+  import lingvo.compat as tf
+  from lingvo.core import layers
+  # pylint: enable=g-import-not-at-top
+  if 'shared_emb' not in p.encoder or 'shared_emb' not in p.decoder:
+    tf.logging.warning('RNMT encoder/decoder have no shared_emb param; '
+                       'keeping separate embeddings and softmax.')
+    return False
+  softmax = p.decoder.softmax
+  assert p.decoder.emb.embedding_dim == softmax.input_dim, (
+      'Tying needs embedding_dim == softmax input_dim')
+  shared_emb = layers.SharedSoftmaxLayer.Params().Set(
+      name='shared_emb',
+      input_dim=softmax.input_dim,
+      num_classes=softmax.num_classes,
+      num_shards=softmax.num_shards,
+      scale_sqrt_depth=True)
+  p.encoder.shared_emb = shared_emb
+  p.decoder.shared_emb = shared_emb
+  return True
 
 
 # This base class defines parameters for the input generator for a specific
 # dataset. Specific network architectures will be implemented in subclasses.
-class RNMTModel(base_model_params.SingleTaskModelParams):
-  """Brown Corpus data with a Word-Piece Model tokenizer."""
-
-  # Generated using
-  # lingvo/tasks/punctuator/tools:download_brown_corpus.
-  _DATADIR = '/tmp/punctuator_data'
-  _VOCAB_FILE = tf.resource_loader.get_path_to_datafile(
-      'brown_corpus_wpm.16000.vocab')
-  # _VOCAB_SIZE needs to be a multiple of 16 because we use a sharded softmax
-  # with 16 shards.
-  _VOCAB_SIZE = 16000
+@model_registry.RegisterSingleTaskModel
+class RNMTModel(codelab_params.RNMTConfig,
+                base_model_params.SingleTaskModelParams):
+  """Brown Corpus data with a Word-Piece Model tokenizer.
+
+  See codelab_params.RNMTConfig for the data locations and architecture.
+  """
+
+  def _SetBuckets(self, p, split):
+    import bucketing  # pylint: disable=g-import-not-at-top
+    buckets = bucketing.LoadBuckets(self._BucketsFile(), split)
+    if buckets:
+      p.bucket_upper_bound, p.bucket_batch_limit = buckets
+    return p
 
   def Train(self):
+    import lingvo.compat as tf  # pylint: disable=g-import-not-at-top
+    import input_generator  # pylint: disable=g-import-not-at-top
     p = input_generator.PunctuatorInput.Params()
-    p.file_pattern = 'text:' + os.path.join(self._DATADIR, 'train.txt')
+    tokenized_prefix = self._TokenizedTrainPrefix()
+    if tf.io.gfile.glob(tokenized_prefix + '-*-of-*'):
+      p.file_pattern = 'tfrecord:' + tokenized_prefix + '-*-of-*'
+    else:
+      p.file_pattern = 'text:' + os.path.join(self._DataDir(),
+                                              self._TRAIN_FILES)
     p.file_random_seed = 0  # Do not use a fixed seed.
-    p.file_parallelism = 1  # We only have a single input file.
+    # Read the shards in parallel; a single file gets a single reader.
+    p.file_parallelism = _FileParallelism(p.file_pattern)
 
     # The bucket upper bound specifies how to split the input into buckets. We
     # train on sequences up to maximum bucket size and discard longer examples.
@@ -40,8 +99,9 @@ class RNMTModel(base_model_params.SingleTaskModelParams):
     # memory, for example; and ideographical languages like Chinese may benefit
     # from more buckets.
     p.bucket_batch_limit = [512, 256, 160, 80, 40]
+    self._SetBuckets(p, 'train')
 
-    p.tokenizer.vocab_filepath = self._VOCAB_FILE
+    p.tokenizer.vocab_filepath = self._VocabFile()
     p.tokenizer.vocab_size = self._VOCAB_SIZE
     p.tokenizer.pad_to_max_length = False
 
@@ -53,8 +113,9 @@ class RNMTModel(base_model_params.SingleTaskModelParams):
 
   # There is also a Dev method for dev set params, but we don't have a dev set.
   def Test(self):
+    import input_generator  # pylint: disable=g-import-not-at-top
     p = input_generator.PunctuatorInput.Params()
-    p.file_pattern = 'text:' + os.path.join(self._DATADIR, 'test.txt')
+    p.file_pattern = 'text:' + os.path.join(self._DataDir(), 'test.txt')
     p.file_random_seed = 27182818  # Fix random seed for testing.
     # The following two parameters are important if there's more than one input
     # file. For this codelab it doesn't actually matter.
@@ -65,8 +126,9 @@ class RNMTModel(base_model_params.SingleTaskModelParams):
 
     p.bucket_upper_bound = [10, 20, 30, 60, 120, 200]
     p.bucket_batch_limit = [16] * 4 + [4] * 2
+    self._SetBuckets(p, 'test')
 
-    p.tokenizer.vocab_filepath = self._VOCAB_FILE
+    p.tokenizer.vocab_filepath = self._VocabFile()
     p.tokenizer.vocab_size = self._VOCAB_SIZE
     p.tokenizer.pad_to_max_length = False
 
@@ -75,15 +137,19 @@ class RNMTModel(base_model_params.SingleTaskModelParams):
     return p
 
   def Task(self):
+    # pylint: disable=g-import-not-at-top
+    from lingvo.tasks.mt import base_config
+    from lingvo.tasks.punctuator import model
+    # pylint: enable=g-import-not-at-top
     p = base_config.SetupRNMTParams(
         model.RNMTModel.Params(),
         name='punctuator_rnmt',
         vocab_size=self._VOCAB_SIZE,
-        embedding_dim=1024,
-        hidden_dim=1024,
-        num_heads=4,
-        num_encoder_layers=6,
-        num_decoder_layers=8,
+        embedding_dim=self._EMBEDDING_DIM,
+        hidden_dim=self._HIDDEN_DIM,
+        num_heads=self._NUM_HEADS,
+        num_encoder_layers=self._NUM_ENCODER_LAYERS,
+        num_decoder_layers=self._NUM_DECODER_LAYERS,
         learning_rate=1e-4,
         l2_regularizer_weight=1e-5,
         lr_warmup_steps=500,
@@ -97,4 +163,23 @@ class RNMTModel(base_model_params.SingleTaskModelParams):
         adam_epsilon=1e-6,
     )
     p.eval.samples_per_summary = 2466
+    if self._SHARE_EMBEDDINGS:
+      _ShareEmbeddings(p)
     return p
+
+
+# Lighter variants for CPU serving. rnmt_variant_report.py lists their
+# parameter count, step time and decode speed.
+@model_registry.RegisterSingleTaskModel
+class RNMTModelSmall(codelab_params.RNMTSmallConfig, RNMTModel):
+  """Narrower layers and half the decoder layers."""
+
+
+@model_registry.RegisterSingleTaskModel
+class RNMTModelTiny(codelab_params.RNMTTinyConfig, RNMTModel):
+  """256-dim RNMT with 4 encoder and 2 decoder layers."""
+
+
+@model_registry.RegisterSingleTaskModel
+class RNMTModelTinyShared(codelab_params.RNMTTinySharedConfig, RNMTModelTiny):
+  """RNMTModelTiny with shared embeddings and a tied softmax."""
@@ -0,0 +1,144 @@
+"""Configuration of the codelab RNMT variants, importable without lingvo.
+
+Data and vocab locations and the architecture of every variant live here, so
+that they can be listed or inspected without importing TensorFlow. codelab.py
+mixes these classes into the registered SingleTaskModelParams and builds the
+input and task params from them.
+
+  python codelab_params.py
+"""
+
+import argparse
+import json
+import os
+
+
+class RNMTConfig(object):
+  """Brown Corpus data with a Word-Piece Model tokenizer.
+
+  The data directory and vocab file can be overridden with the
+  PUNCTUATOR_DATADIR and PUNCTUATOR_VOCAB environment variables.
+  """
+
+  # Generated using
+  # lingvo/tasks/punctuator/tools:download_brown_corpus.
+  _DATADIR = '/tmp/punctuator_data'
+  # Looked up next to this file by _VocabFile().
+  _VOCAB_FILENAME = 'brown_corpus_wpm.16000.vocab'
+  # _VOCAB_SIZE needs to be a multiple of 16 because we use a sharded softmax
+  # with 16 shards.
+  _VOCAB_SIZE = 16000
+  # The training text may be split into shards, e.g. train.txt-00000-of-00016.
+  _TRAIN_FILES = 'train.txt*'
+
+  # Architecture of Task(). The lighter variants below override these and
+  # share the input pipeline.
+  _EMBEDDING_DIM = 1024
+  _HIDDEN_DIM = 1024
+  _NUM_HEADS = 4
+  _NUM_ENCODER_LAYERS = 6
+  _NUM_DECODER_LAYERS = 8
+  # Tie the decoder embedding and softmax, and share them with the encoder.
+  _SHARE_EMBEDDINGS = False
+
+  @classmethod
+  def _DataDir(cls):
+    return os.environ.get('PUNCTUATOR_DATADIR', cls._DATADIR)
+
+  @classmethod
+  def _VocabFile(cls):
+    if os.environ.get('PUNCTUATOR_VOCAB'):
+      return os.environ['PUNCTUATOR_VOCAB']
+    import lingvo.compat as tf  # pylint: disable=g-import-not-at-top
+    return tf.resource_loader.get_path_to_datafile(cls._VOCAB_FILENAME)
+
+  @classmethod
+  def _TokenizedTrainPrefix(cls):
+    """Output prefix of PunctuatorInput.PreTokenize for the training set.
+
+    When the shards exist, Train() reads the pre-tokenized ids instead of
+    re-tokenizing the text every epoch:
+      RNMTModel().Train().Instantiate().PreTokenize(
+          os.path.join(RNMTModel._DataDir(), 'train.txt*'),
+          RNMTModel._TokenizedTrainPrefix())
+    """
+    return os.path.join(cls._DataDir(), 'train.tokenized')
+
+  @classmethod
+  def _BucketsFile(cls):
+    """Buckets derived from the corpus length histogram by bucketing.py.
+
+    When the file has an entry for a split, it replaces the hand-tuned buckets
+    of that split.
+    """
+    return os.path.join(cls._DataDir(), 'buckets.json')
+
+
+# Lighter variants for CPU serving. rnmt_variant_report.py lists their
+# parameter count, step time and decode speed.
+class RNMTSmallConfig(RNMTConfig):
+  """Narrower layers and half the decoder layers."""
+
+  _EMBEDDING_DIM = 512
+  _HIDDEN_DIM = 512
+  _NUM_DECODER_LAYERS = 4
+
+
+class RNMTTinyConfig(RNMTConfig):
+  """256-dim RNMT with 4 encoder and 2 decoder layers."""
+
+  _EMBEDDING_DIM = 256
+  _HIDDEN_DIM = 256
+  _NUM_HEADS = 2
+  _NUM_ENCODER_LAYERS = 4
+  _NUM_DECODER_LAYERS = 2
+
+
+class RNMTTinySharedConfig(RNMTTinyConfig):
+  """RNMTTinyConfig with shared embeddings and a tied softmax."""
+
+  _SHARE_EMBEDDINGS = True
+
+
+# Registered name in codelab.py -> configuration.
+VARIANTS = {
+    'RNMTModel': RNMTConfig,
+    'RNMTModelSmall': RNMTSmallConfig,
+    'RNMTModelTiny': RNMTTinyConfig,
+    'RNMTModelTinyShared': RNMTTinySharedConfig,
+}
+
+
+def Describe(config):
+  """Returns the data locations and architecture of `config` as a dict.
+
+  The vocab is reported as given by PUNCTUATOR_VOCAB, or else by its file name;
+  resolving the default path would need lingvo.
+  """
+  # pylint: disable=protected-access
+  return {
+      'data_dir': config._DataDir(),
+      'vocab': os.environ.get('PUNCTUATOR_VOCAB') or config._VOCAB_FILENAME,
+      'vocab_size': config._VOCAB_SIZE,
+      'train_files': config._TRAIN_FILES,
+      'embedding_dim': config._EMBEDDING_DIM,
+      'hidden_dim': config._HIDDEN_DIM,
+      'num_heads': config._NUM_HEADS,
+      'num_encoder_layers': config._NUM_ENCODER_LAYERS,
+      'num_decoder_layers': config._NUM_DECODER_LAYERS,
+      'share_embeddings': config._SHARE_EMBEDDINGS,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Lists the codelab RNMT variants without importing lingvo.')
+  parser.add_argument('names', nargs='*', help='Variants to list; default all.')
+  args = parser.parse_args()
+  names = args.names or list(VARIANTS)
+  print(json.dumps({name: Describe(VARIANTS[name]) for name in names},
+                   indent=2))
+
+
+if __name__ == '__main__':
+  main()
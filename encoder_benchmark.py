@@ -0,0 +1,71 @@
+"""
+比较GRU的Encoder和SelfAttnEncoder在不同源句长度下的速度。
+
+    python encoder_benchmark.py --layers 1 --lengths 16,32,64,128 --batch_size 32 --output encoders.md
+
+两种encoder使用对应层数脚本里的超参数，输入为随机token。对每个长度报告推理(no_grad)的
+forward时间和训练时forward+backward的时间(毫秒)，以及参数量。
+"""
+
+import argparse
+
+import torch
+
+import model_loader
+
+COLUMNS = [("encoder", "l", "%s"), ("length", "r", "%d"), ("infer (ms)", "r", "%.2f"), ("train (ms)", "r", "%.2f")]
+
+
+def build_encoders(script):
+    gru = script.Encoder(script.INPUT_DIM, script.ENC_EMB_DIM, script.HID_DIM, script.N_LAYERS,
+                         script.ENC_DROPOUT, script.bidirectional)
+    self_attn = script.SelfAttnEncoder(script.INPUT_DIM, script.ENC_EMB_DIM, script.HID_DIM, script.N_LAYERS,
+                                       script.SELF_ATTN_DROPOUT, script.bidirectional, script.SELF_ATTN_HEADS)
+    return [("gru", gru.to(script.device)), ("self_attention", self_attn.to(script.device))]
+
+
+def time_encoder(encoder, src, lengths, repeats, train):
+    """返回平均每次的毫秒数"""
+    encoder.train(train)
+
+    def run():
+        if train:
+            outputs, hidden = encoder(src, lengths)
+            (outputs.sum() + hidden.sum()).backward()
+        else:
+            with torch.no_grad():
+                encoder(src, lengths)
+
+    return 1000 * model_loader.time_calls(run, repeats, warmup=1, device=src.device)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GRU vs self-attention encoder benchmark")
+    parser.add_argument("--layers", type=int, default=1, choices=sorted(model_loader.LAYER_SCRIPTS))
+    parser.add_argument("--lengths", default="16,32,64,128")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--output", default=None, help="把markdown表格也写到这个文件")
+    args = parser.parse_args()
+
+    script = model_loader.load_script(args.layers)
+    encoders = build_encoders(script)
+    print(f'{args.layers} layer(s), batch size {args.batch_size}, {torch.get_num_threads()} threads')
+    for name, encoder in encoders:
+        print('%-15s %6.1fM params' % (name, sum(p.numel() for p in encoder.parameters()) / 1e6))
+
+    print()
+    rows = []
+    for length in map(int, args.lengths.split(',')):
+        src = torch.randint(len(script.basic_dict), script.INPUT_DIM, (length, args.batch_size),
+                            device=script.device)
+        lengths = [length] * args.batch_size
+        for name, encoder in encoders:
+            infer_ms = time_encoder(encoder, src, lengths, args.repeats, train=False)
+            train_ms = time_encoder(encoder, src, lengths, args.repeats, train=True)
+            rows.append((name, length, infer_ms, train_ms))
+    model_loader.write_report(model_loader.markdown_table(COLUMNS, rows), args.output)
+
+
+if __name__ == "__main__":
+    main()
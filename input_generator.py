@@ -1,13 +1,186 @@
+"""Punctuator input generator."""
+
+import string
+
+import lingvo.compat as tf
+from lingvo.core import base_input_generator
+from lingvo.core import generic_input
+from lingvo.core import py_utils
+from lingvo.core import tokenizers
+
+# Prefix of file patterns that point at shards written by PreTokenize().
+_TOKENIZED_PREFIX = 'tfrecord:'
+
+# RE2 character classes matching string.punctuation and the ASCII whitespace
+# that bytes.split() splits on.
+_PUNCTUATION_RE = '[%s]' % ''.join('\\' + c for c in string.punctuation)
+_WHITESPACE_RE = '[ \\t\\n\\r\\v\\f]+'
+# Word-start marker of WPM pieces.
+_WORD_START = '\u2581'
+
+
+def PyNormalize(line):
+  """Lowercases and removes punctuation from a bytes line (python version)."""
+  line = line.lower().translate(None, string.punctuation.encode('utf-8'))
+  # Convert multiple consecutive spaces to a single one.
+  line = b' '.join(line.split())
+  return line
+
+
+def Normalize(line):
+  """Graph-native equivalent of `PyNormalize` built on tf.strings ops.
+
+  Like bytes.lower(), tf.strings.lower only changes ASCII letters, so the output
+  is byte-for-byte identical to `PyNormalize`.
+
+  Args:
+    line: a string tensor of any shape.
+
+  Returns:
+    The normalized string tensor, with the same shape as `line`.
+  """
+  line = tf.strings.lower(line)
+  line = tf.strings.regex_replace(line, _PUNCTUATION_RE, '')
+  line = tf.strings.regex_replace(line, _WHITESPACE_RE, ' ')
+  return tf.strings.strip(line)
+
+
+def _SourceIdTable(vocab_filepath):
+  """Maps every wordpiece id to the id of its normalized wordpiece.
+
+  Normalizing a piece lowercases its ASCII letters and removes punctuation, the
+  same way `Normalize` treats a line. Pieces with nothing but punctuation (and
+  the word-start marker) map to -1 and are dropped; pieces whose normalized form
+  is not in the vocab map to <unk>. Special tokens such as </s> map to
+  themselves.
+
+  Args:
+    vocab_filepath: the WPM vocab file, one piece per line, optionally followed
+      by a tab and its count.
+
+  Returns:
+    A list of ints, indexed by wordpiece id.
+  """
+  with tf.io.gfile.GFile(vocab_filepath, 'r') as f:
+    pieces = [line.rstrip('\n').split('\t')[0] for line in f]
+  piece_to_id = {piece: i for i, piece in enumerate(pieces)}
+  unk_id = piece_to_id.get('<unk>', 0)
+  delete_punctuation = str.maketrans('', '', string.punctuation)
+  table = []
+  for i, piece in enumerate(pieces):
+    if piece.startswith('<') and piece.endswith('>'):
+      table.append(i)
+      continue
+    normalized = ''.join(c.lower() if c.isascii() else c for c in piece)
+    normalized = normalized.translate(delete_punctuation)
+    if not normalized.strip(_WORD_START):
+      table.append(-1)
+    else:
+      table.append(piece_to_id.get(normalized, unk_id))
+  return table
+
+
 class PunctuatorInput(base_input_generator.BaseSequenceInputGenerator):
-  """Reads text line by line and processes them for the punctuator task."""
+  """Reads text line by line and processes them for the punctuator task.
+
+  `file_pattern` may be a single text file, a sharded/glob text pattern (e.g.
+  'text:/data/train-*-of-00016'), read with `file_parallelism` readers, or a
+  'tfrecord:' pattern of shards written by `PreTokenize`, in which case the
+  tokenizer is skipped entirely.
+  """
 
   @classmethod
   def Params(cls):
     """Defaults params for PunctuatorInput."""
     p = super().Params()
     p.tokenizer = tokenizers.WpmTokenizer.Params()
+    p.Define(
+        'normalize_with_py_func', False,
+        'If True, normalize the source with the legacy tf.py_func instead of '
+        'native tf.strings ops. Only useful for benchmarking.')
+    p.Define(
+        'source_tokenization', 'tokenize',
+        'How source ids are computed. "tokenize": run the tokenizer again on '
+        'the normalized line (exact, two tokenizer passes per line). '
+        '"derive": map the target wordpieces through a precomputed table that '
+        'lowercases them and drops punctuation-only pieces (one pass, but '
+        'approximate: words WPM would split differently without punctuation '
+        'or capitals come out differently). "cache": like "tokenize", but '
+        'memoizes the source ids of repeated normalized lines (exact).')
+    p.Define(
+        'source_cache_size', 100000,
+        'Maximum number of normalized lines to memoize when '
+        'source_tokenization is "cache".')
     return p
 
+  def __init__(self, params):
+    super().__init__(params)
+    p = self.params
+    if p.source_tokenization == 'derive':
+      self._source_id_values = _SourceIdTable(p.tokenizer.vocab_filepath)
+    elif p.source_tokenization not in ('tokenize', 'cache'):
+      raise ValueError('Unknown source_tokenization: %s' %
+                       p.source_tokenization)
+    # The id table and the cache are created in the graph that calls
+    # _ProcessLine (the input pipeline's, or the one PreTokenize builds), not
+    # in whatever graph happens to be the default here.
+    self._graph_resources = {}
+
+  def _GraphResource(self, name, create_fn):
+    """Returns the `name` resource of the default graph, creating it once."""
+    key = (tf.get_default_graph(), name)
+    if key not in self._graph_resources:
+      self._graph_resources[key] = create_fn()
+    return self._graph_resources[key]
+
+  def _SourceIdTableTensor(self):
+    return self._GraphResource(
+        'source_id_table',
+        lambda: tf.constant(self._source_id_values, dtype=tf.int32))
+
+  def _SourceCache(self):
+    # The table is shared by node name, so it outlives a single call of the
+    # input processing function, which may be traced into its own graph.
+    return self._GraphResource(
+        'source_cache', lambda: tf.lookup.experimental.MutableHashTable(
+            key_dtype=tf.string,
+            value_dtype=tf.string,
+            default_value='',
+            name='source_cache_%d' % id(self)))
+
+  def _DeriveSourceIds(self, tgt_labels, tgt_paddings):
+    """Derives source labels/paddings from the target tokenization."""
+    ids = tf.gather(self._SourceIdTableTensor(), tgt_labels[0])
+    keep = tf.logical_and(ids >= 0, tf.equal(tgt_paddings[0], 0.0))
+    src_labels = tf.expand_dims(tf.boolean_mask(ids, keep), 0)
+    return src_labels, tf.zeros(tf.shape(src_labels), dtype=tf.float32)
+
+  def _CachedSourceIds(self, normalized_line):
+    """Tokenizes `normalized_line` as a source, memoizing repeated lines."""
+    p = self.params
+    source_cache = self._SourceCache()
+    cached = source_cache.lookup(normalized_line)
+
+    def _Tokenize():
+      _, labels, paddings = self.StringsToIds(
+          tf.convert_to_tensor([normalized_line]), is_source=True)
+      # Labels and paddings are stored together as one serialized [2, 1, len]
+      # int32 tensor; paddings are always 0 or 1.
+      value = tf.io.serialize_tensor(
+          tf.stack([labels, tf.cast(paddings, tf.int32)]))
+      insert = tf.cond(
+          source_cache.size() < p.source_cache_size,
+          lambda: tf.group(source_cache.insert(normalized_line, value)),
+          tf.no_op)
+      with tf.control_dependencies([insert]):
+        return tf.identity(value)
+
+    serialized = tf.cond(
+        tf.equal(cached, ''), _Tokenize, lambda: tf.identity(cached))
+    labels_and_paddings = tf.reshape(
+        tf.io.parse_tensor(serialized, tf.int32), [2, 1, -1])
+    return labels_and_paddings[0], tf.cast(labels_and_paddings[1], tf.float32)
+
   def _ProcessLine(self, line):
     """A single-text-line processor.
 
@@ -25,19 +198,23 @@ class PunctuatorInput(base_input_generator.BaseSequenceInputGenerator):
     # Tokenize the input into integer ids.
     # tgt_ids has the start-of-sentence token prepended, and tgt_labels has the
     # end-of-sentence token appended.
+    p = self.params
     tgt_ids, tgt_labels, tgt_paddings = self.StringsToIds(
         tf.convert_to_tensor([line]))
 
-    def Normalize(line):
-      # Lowercase and remove punctuation.
-      line = line.lower().translate(None, string.punctuation.encode('utf-8'))
-      # Convert multiple consecutive spaces to a single one.
-      line = b' '.join(line.split())
-      return line
-
-    normalized_line = tf.py_func(Normalize, [line], tf.string, stateful=False)
-    _, src_labels, src_paddings = self.StringsToIds(
-        tf.convert_to_tensor([normalized_line]), is_source=True)
+    if p.source_tokenization == 'derive':
+      src_labels, src_paddings = self._DeriveSourceIds(tgt_labels, tgt_paddings)
+    else:
+      if p.normalize_with_py_func:
+        normalized_line = tf.py_func(
+            PyNormalize, [line], tf.string, stateful=False)
+      else:
+        normalized_line = Normalize(line)
+      if p.source_tokenization == 'cache':
+        src_labels, src_paddings = self._CachedSourceIds(normalized_line)
+      else:
+        _, src_labels, src_paddings = self.StringsToIds(
+            tf.convert_to_tensor([normalized_line]), is_source=True)
     # The model expects the source without a start-of-sentence token.
     src_ids = src_labels
 
@@ -55,6 +232,107 @@ class PunctuatorInput(base_input_generator.BaseSequenceInputGenerator):
     ]
     return [tf.squeeze(t, axis=0) for t in out_tensors], bucket_key
 
+  def _ProcessTokenizedRecord(self, record):
+    """A processor for records written by `PreTokenize`.
+
+    Args:
+      record: a scalar string tensor holding a serialized tf.train.Example.
+
+    Returns:
+      A list of tensors in the same order as `_ProcessLine`, and the bucket key.
+    """
+    features = tf.io.parse_single_example(
+        record, {
+            'src_ids': tf.io.VarLenFeature(tf.int64),
+            'tgt_ids': tf.io.VarLenFeature(tf.int64),
+            'tgt_labels': tf.io.VarLenFeature(tf.int64),
+            'bucket_key': tf.io.FixedLenFeature([], tf.int64),
+        })
+    src_ids = tf.cast(tf.sparse.to_dense(features['src_ids']), tf.int32)
+    tgt_ids = tf.cast(tf.sparse.to_dense(features['tgt_ids']), tf.int32)
+    tgt_labels = tf.cast(tf.sparse.to_dense(features['tgt_labels']), tf.int32)
+    # Only the unpadded prefix is stored, so every position is real.
+    src_paddings = tf.zeros(tf.shape(src_ids), dtype=tf.float32)
+    tgt_paddings = tf.zeros(tf.shape(tgt_ids), dtype=tf.float32)
+    tgt_weights = 1.0 - tgt_paddings
+    bucket_key = tf.cast(features['bucket_key'], tf.int32)
+    return [
+        src_ids, src_paddings, tgt_ids, tgt_paddings, tgt_labels, tgt_weights
+    ], bucket_key
+
+  def PreTokenize(self, text_file_pattern, output_prefix, num_shards=16):
+    """Tokenizes text once and writes the results to TFRecord shards.
+
+    Each record stores the unpadded src ids, tgt ids, tgt labels and the bucket
+    key produced by `_ProcessLine`, so training on
+    'tfrecord:<output_prefix>-*-of-<num_shards>' never runs the tokenizer. The
+    shards are only valid for the tokenizer and max length params used here.
+
+    Args:
+      text_file_pattern: glob of plain text files, one example per line.
+      output_prefix: path prefix of the output shards.
+      num_shards: number of output shards; lines are written round-robin.
+
+    Returns:
+      The file pattern (with the 'tfrecord:' prefix) of the written shards.
+    """
+    with tf.Graph().as_default():
+      line = tf.placeholder(tf.string, shape=[])
+      (src_ids, src_paddings, tgt_ids, tgt_paddings, tgt_labels,
+       _), bucket_key = self._ProcessLine(line)
+      src_len = tf.cast(tf.round(tf.reduce_sum(1.0 - src_paddings)), tf.int32)
+      tgt_len = tf.cast(tf.round(tf.reduce_sum(1.0 - tgt_paddings)), tf.int32)
+      fetches = [
+          src_ids[:src_len], tgt_ids[:tgt_len], tgt_labels[:tgt_len],
+          bucket_key
+      ]
+
+      def _Int64List(values):
+        return tf.train.Feature(
+            int64_list=tf.train.Int64List(value=[int(v) for v in values]))
+
+      paths = [
+          '%s-%05d-of-%05d' % (output_prefix, i, num_shards)
+          for i in range(num_shards)
+      ]
+      writers = [tf.io.TFRecordWriter(path) for path in paths]
+      num_lines = 0
+      with tf.Session() as sess:
+        for filename in sorted(tf.io.gfile.glob(text_file_pattern)):
+          with tf.io.gfile.GFile(filename, 'rb') as f:
+            for text in f:
+              text = text.rstrip(b'\n')
+              src, tgt, labels, key = sess.run(fetches, {line: text})
+              example = tf.train.Example(
+                  features=tf.train.Features(
+                      feature={
+                          'src_ids': _Int64List(src),
+                          'tgt_ids': _Int64List(tgt),
+                          'tgt_labels': _Int64List(labels),
+                          'bucket_key': _Int64List([key]),
+                      }))
+              writers[num_lines % num_shards].write(
+                  example.SerializeToString())
+              num_lines += 1
+      for writer in writers:
+        writer.close()
+    tf.logging.info('Wrote %d tokenized examples to %d shards at %s', num_lines,
+                    num_shards, output_prefix)
+    return '%s%s-*-of-%05d' % (_TOKENIZED_PREFIX, output_prefix, num_shards)
+
+  def BucketKeys(self, lines):
+    """Returns the bucket key `_ProcessLine` computes for each of `lines`.
+
+    That is the longer of the source and the target in wordpieces, including
+    </s>. Lines longer than source_max_length/target_max_length come out
+    truncated to it, as they do in the input pipeline.
+    """
+    with tf.Graph().as_default():
+      line = tf.placeholder(tf.string, shape=[])
+      _, bucket_key = self._ProcessLine(line)
+      with tf.Session() as sess:
+        return [int(sess.run(bucket_key, {line: text})) for text in lines]
+
   def _DataSourceFromFilePattern(self, file_pattern):
     """Create the input processing op.
 
@@ -67,10 +345,15 @@ class PunctuatorInput(base_input_generator.BaseSequenceInputGenerator):
     """
     ret = py_utils.NestedMap()
 
+    if file_pattern.startswith(_TOKENIZED_PREFIX):
+      processor = self._ProcessTokenizedRecord
+    else:
+      processor = self._ProcessLine
+
     (src_ids, src_paddings, tgt_ids, tgt_paddings, tgt_labels,
      tgt_weights), ret.bucket_keys = generic_input.GenericInput(
          file_pattern=file_pattern,
-         processor=self._ProcessLine,
+         processor=processor,
          # Pad dimension 0 to the same length.
          dynamic_padding_dimensions=[0] * 6,
          # The constant values to use for padding each of the outputs.
@@ -0,0 +1,176 @@
+"""
+加载训练好的Seq2Seq模型，供翻译服务、导出和benchmark等工具使用。
+模型定义、词典和超参数来自 onelayer.py / twolayer.py / threelayer.py，
+import这些脚本只会构建词典和模型，不会训练。
+"""
+
+import importlib
+import os
+import time
+
+import torch
+
+LAYER_SCRIPTS = {1: "onelayer", 2: "twolayer", 3: "threelayer"}
+
+
+def load_script(n_layers):
+    return importlib.import_module(LAYER_SCRIPTS[n_layers])
+
+
+def checkpoint_version(path):
+    """checkpoint的版本标识(路径+修改时间)，重新训练保存后会变化"""
+    return "%s@%d" % (os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+
+def load_checkpoint(model, path, device=None):
+    """把checkpoint加载到model，并更新model.version(翻译缓存据此失效)。只读取权重，不执行pickle里的代码"""
+    model.load_state_dict(torch.load(path, map_location=device or model.device, weights_only=True))
+    model.version = checkpoint_version(path)
+    model.eval()
+    return model
+
+
+def load_model(n_layers=1, checkpoint=None, device=None):
+    """
+    返回 (script, model)，model已加载checkpoint(默认为脚本的MODEL_PATH)并处于eval模式。
+    device=None时使用脚本里的device。
+    """
+    script = load_script(n_layers)
+    model = script.model
+    device = torch.device(device) if device is not None else script.device
+    model.to(device)
+    model.device = device
+    load_checkpoint(model, checkpoint or script.MODEL_PATH, device)
+    return script, model
+
+
+def normalize_source(sentence):
+    """合并多余的空白，模型是字符级的，所以不改大小写和标点"""
+    return " ".join(sentence.split())
+
+
+def source_ids(script, sentence):
+    """按脚本的切分方式(字符或子词)把一句英文映射成id并添加<eos>，未登录的token映射为<unk>"""
+    unk = script.en2id["<unk>"]
+    return [script.en2id.get(token, unk) for token in script.tokenize_source(sentence)] + [script.en2id["<eos>"]]
+
+
+def encode_source(script, sentence, device=None):
+    """把一句英文编码成 translate() 需要的sample"""
+    tokens = source_ids(script, sentence)
+    return {
+        "src": torch.tensor(tokens, dtype=torch.long, device=device or script.device).reshape(-1, 1),
+        "src_len": [len(tokens)],
+    }
+
+
+def encode_batch(script, sentences, device=None):
+    """把多句英文补齐成 translate_batch() 需要的batch: {"src": [seq_len, batch], "src_len": list}"""
+    ids = [source_ids(script, sentence) for sentence in sentences]
+    max_len = max(len(tokens) for tokens in ids)
+    pad = script.en2id["<pad>"]
+    src = [tokens + [pad] * (max_len - len(tokens)) for tokens in ids]
+    return {
+        "src": torch.tensor(src, dtype=torch.long, device=device or script.device).T,
+        "src_len": [len(tokens) for tokens in ids],
+    }
+
+
+def load_pairs(path="newdata"):
+    """读取 newdata 格式(英文\\t德文)的平行语料，返回 [(src, trg), ...]"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = f.read().strip().split('\n')
+    return [tuple(line.split('\t')[:2]) for line in data]
+
+
+def eval_pairs(script, path=None):
+    """path为None时返回脚本留出、不参与训练的 holdout_pairs，否则读取path"""
+    if path is None:
+        return script.holdout_pairs
+    return load_pairs(path)
+
+
+def evaluate_model(script, model, pairs, warmup=5):
+    """逐句翻译，返回 (译文列表, 每句延迟(秒)列表)"""
+    samples = [encode_source(script, src, device="cpu") for src, _ in pairs]
+    with torch.no_grad():
+        for sample in samples[:warmup]:
+            script.translate(model, sample, script.id2ch)
+        hypotheses, latencies = [], []
+        for sample in samples:
+            start = time.perf_counter()
+            hypotheses.append(script.translate(model, sample, script.id2ch))
+            latencies.append(time.perf_counter() - start)
+    return hypotheses, latencies
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def _sync(device):
+    if device is not None and torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def time_calls(fn, repeats, warmup=1, device=None, before_timing=None):
+    """
+    先调用warmup次fn()预热，再计时repeats次，返回平均每次的秒数。
+    device是cuda时在计时前后同步；before_timing在预热之后、开始计时之前调用(例如重置峰值内存统计)
+    """
+    for _ in range(warmup):
+        fn()
+    if before_timing is not None:
+        before_timing()
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    _sync(device)
+    return (time.perf_counter() - start) / repeats
+
+
+def train_step_seconds(script, model, optimizer, steps, warmup=1, batch_size=None, data=None, before_timing=None):
+    """
+    用脚本的 train() 一次训练一个batch：前warmup个batch预热，之后的steps个batch计时，返回每个step的秒数。
+    data为 (en_num_data, ch_num_data)，默认为脚本的训练数据；batch_size默认为脚本的BATCH_SIZE。
+    batch在计时之前就补齐好，计时不包括DataLoader
+    """
+    from torch.utils.data import DataLoader, Subset
+
+    batch_size = batch_size or script.BATCH_SIZE
+    en_num_data, ch_num_data = data or (script.en_num_data, script.ch_num_data)
+    dataset = script.TranslationDataset(en_num_data, ch_num_data)
+    if len(dataset) < (warmup + steps) * batch_size:
+        raise ValueError("need %d sentences for %d+%d steps of batch size %d, got %d" % (
+            (warmup + steps) * batch_size, warmup, steps, batch_size, len(dataset)))
+    batches = iter(list(DataLoader(Subset(dataset, range((warmup + steps) * batch_size)),
+                                   batch_size=batch_size, collate_fn=script.padding_batch)))
+    return time_calls(lambda: script.train(model, [next(batches)], optimizer, script.CLIP),
+                      steps, warmup, script.device, before_timing)
+
+
+# 对齐方式 -> markdown表格的分隔行
+_ALIGN = {"l": "---", "r": "---:", "c": ":---:"}
+
+
+def markdown_row(columns, values):
+    """columns为 [(列名, 对齐方式'l'/'r'/'c', 格式), ...]，按各列的格式把values排成一行"""
+    return "| " + " | ".join(fmt % value for (_, _, fmt), value in zip(columns, values)) + " |"
+
+
+def markdown_table(columns, rows):
+    """返回表头、分隔行和rows组成的markdown表格文本"""
+    lines = ["| " + " | ".join(name for name, _, _ in columns) + " |",
+             "|" + "|".join(_ALIGN[align] for _, align, _ in columns) + "|"]
+    lines += [markdown_row(columns, values) for values in rows]
+    return "\n".join(lines) + "\n"
+
+
+def write_report(report, output=None):
+    """打印报告，output不为None时也写到这个文件"""
+    print(report)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(report)
@@ -15,49 +15,110 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+import torch.utils.checkpoint
+from torch.utils.data import Dataset, DataLoader, Sampler
 
+import os
 import time
 import math
 import random
+from contextlib import nullcontext
+
+import thread_settings
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# 多进程数据并行(gloo): torchrun --standalone --nproc_per_node=4 <本脚本>
+# 单进程直接运行时 WORLD_SIZE=1，行为与原来一致
+WORLD_SIZE = int(os.environ.get("WORLD_SIZE", 1))
+RANK = int(os.environ.get("RANK", 0))
+if WORLD_SIZE > 1:
+    device = torch.device('cpu')
+    dist.init_process_group(backend="gloo")
+
+# 直接运行训练时，按autotune_threads.py在本机测出的配置设置线程数(没有测过则保持默认)
+# 每台机器上同时跑WORLD_SIZE个进程
+if __name__ == "__main__":
+    thread_settings.apply("train", jobs=WORLD_SIZE)
+
 """read data
 
 """
 
 # 每一行数据如下
 # 'Hi.\t嗨。\tCC-BY 2.0 (France) Attribution: tatoeba.org #538123 (CM) & #891077 (Martha)'
-with open('newdata', 'r', encoding='utf-8') as f:
-    data = f.read()
-data = data.strip()
-data = data.split('\n')
-print('样本数:\n', len(data))
-print('\n样本示例:')
-data[0]
+# 预处理(去重、按长度和长度比过滤)见preprocess.py，结果缓存在 newdata.clean / newdata.stats.json，
+# newdata和参数不变时直接复用
+PREPROCESS = True
+MAX_SEQ_LEN = 150  # 字符数，超过的句对不参与训练
+MAX_LEN_RATIO = 3.0  # 英文和德文字符数之比的上限
+if PREPROCESS:
+    import preprocess
+    # 只有直接运行训练时才由rank 0(在单独的进程里)更新过期的缓存，其他rank等它写完；
+    # import本脚本的工具只读缓存，缓存过期时在本进程里过滤，不写文件也不开进程池
+    if __name__ == "__main__" and RANK == 0:
+        preprocess.preprocess_subprocess('newdata', MAX_SEQ_LEN, MAX_LEN_RATIO)
+    if WORLD_SIZE > 1:
+        dist.barrier()
+    data = preprocess.load_corpus('newdata', MAX_SEQ_LEN, MAX_LEN_RATIO)
+else:
+    with open('newdata', 'r', encoding='utf-8') as f:
+        data = f.read()
+    data = data.strip()
+    data = data.split('\n')
+# 多进程时只有rank 0打印
+if RANK == 0:
+    print('样本数:\n', len(data))
+    print('\n样本示例:', data[0])
 
 en_data = [line.split('\t')[0] for line in data]
 ch_data = [line.split('\t')[1] for line in data]
-print('英文数据:\n', en_data[:10])
-print('\n德文数据:\n', ch_data[:10])
-
-# 按字符级切割，并添加<eos>
-en_token_list = [[char for char in line]+["<eos>"] for line in en_data]
-ch_token_list = [[char for char in line]+["<eos>"] for line in ch_data]
-print('英文数据:\n', en_token_list[:2])
-print('\n德文数据:\n', ch_token_list[:2])
+if RANK == 0:
+    print('英文数据:\n', en_data[:10])
+    print('\n德文数据:\n', ch_data[:10])
+
+# 切分方式："char" 按字符切分；"subword" 用在newdata上训练的sentencepiece子词模型
+# (需要 pip install sentencepiece)，序列更短，encoder和decoder的步数都更少
+TOKENIZATION = "char"
+SUBWORD_MODEL_TYPE = "unigram"  # 或 "bpe"
+SUBWORD_VOCAB_SIZE = 8000
+
+if TOKENIZATION == "subword":
+    import subword
+    # 子词模型只训练一次，保存在 newdata-en.unigram8000.model 等文件里；多进程时由rank 0训练
+    if RANK == 0:
+        subword.get_tokenizer(en_data, "newdata-en", SUBWORD_VOCAB_SIZE, SUBWORD_MODEL_TYPE)
+        subword.get_tokenizer(ch_data, "newdata-ch", SUBWORD_VOCAB_SIZE, SUBWORD_MODEL_TYPE)
+    if WORLD_SIZE > 1:
+        dist.barrier()
+    en_tokenizer = subword.get_tokenizer(en_data, "newdata-en", SUBWORD_VOCAB_SIZE, SUBWORD_MODEL_TYPE)
+    ch_tokenizer = subword.get_tokenizer(ch_data, "newdata-ch", SUBWORD_VOCAB_SIZE, SUBWORD_MODEL_TYPE)
+    tokenize_source = en_tokenizer.encode
+    detokenize = subword.detokenize
+    en_token_list = [tokens+["<eos>"] for tokens in en_tokenizer.encode_batch(en_data)]
+    ch_token_list = [tokens+["<eos>"] for tokens in ch_tokenizer.encode_batch(ch_data)]
+else:
+    # 按字符级切割，并添加<eos>
+    tokenize_source = list
+    detokenize = "".join
+    en_token_list = [[char for char in line]+["<eos>"] for line in en_data]
+    ch_token_list = [[char for char in line]+["<eos>"] for line in ch_data]
+if RANK == 0:
+    print('英文数据:\n', en_token_list[:2])
+    print('\n德文数据:\n', ch_token_list[:2])
 
 # 基本字典
 basic_dict = {'<pad>':0, '<unk>':1, '<bos>':2, '<eos>':3}
 # 分别生成德英文字典 
-en_vocab = set(''.join(en_data))
+# 排序保证每个进程(以及每次运行)得到相同的id映射
+en_vocab = sorted(set(token for line in en_token_list for token in line[:-1]))
 en2id = {char:i+len(basic_dict) for i, char in enumerate(en_vocab)}
 en2id.update(basic_dict)
 id2en = {v:k for k,v in en2id.items()}
 
 # 分别生成德英文字典 
-ch_vocab = set(''.join(ch_data))
+ch_vocab = sorted(set(token for line in ch_token_list for token in line[:-1]))
 ch2id = {char:i+len(basic_dict) for i, char in enumerate(ch_vocab)}
 ch2id.update(basic_dict)
 id2ch = {v:k for k,v in ch2id.items()}
@@ -66,8 +127,17 @@ id2ch = {v:k for k,v in ch2id.items()}
 en_num_data = [[en2id[en] for en in line ] for line in en_token_list]
 ch_num_data = [[ch2id[ch] for ch in line] for line in ch_token_list]
 
-print('char:', en_data[1])
-print('index:', en_num_data[1])
+if RANK == 0:
+    print('char:', en_data[1])
+    print('index:', en_num_data[1])
+
+# 最后HOLDOUT个句对不参与训练：训练时作为验证集(早停和学习率衰减)，
+# quantize.py和onnx_export.py在上面比较BLEU和延迟(词典仍按全部数据生成)
+HOLDOUT = 500
+n_train = len(data) - HOLDOUT
+holdout_pairs = list(zip(en_data[n_train:], ch_data[n_train:]))
+valid_en_num_data, valid_ch_num_data = en_num_data[n_train:], ch_num_data[n_train:]
+en_num_data, ch_num_data = en_num_data[:n_train], ch_num_data[:n_train]
 
 class TranslationDataset(Dataset):
     def __init__(self, src_data, trg_data):
@@ -102,29 +172,116 @@ def padding_batch(batch):
     
     src_max = max([d["src_len"] for d in batch])
     trg_max = max([d["trg_len"] for d in batch])
-    for d in batch:
-        d["src"].extend([en2id["<pad>"]]*(src_max-d["src_len"]))
-        d["trg"].extend([ch2id["<pad>"]]*(trg_max-d["trg_len"]))
-    srcs = torch.tensor([pair["src"] for pair in batch], dtype=torch.long, device=device)
-    trgs = torch.tensor([pair["trg"] for pair in batch], dtype=torch.long, device=device)
+    # 不能原地extend，否则数据集里的样本会在每个epoch被重复补齐
+    srcs = [d["src"] + [en2id["<pad>"]]*(src_max-d["src_len"]) for d in batch]
+    trgs = [d["trg"] + [ch2id["<pad>"]]*(trg_max-d["trg_len"]) for d in batch]
+    srcs = torch.tensor(srcs, dtype=torch.long, device=device)
+    trgs = torch.tensor(trgs, dtype=torch.long, device=device)
     
     batch = {"src":srcs.T, "src_len":src_lens, "trg":trgs.T, "trg_len":trg_lens}
     return batch
 
+class BucketDistributedSampler(Sampler):
+    """
+    按长度分桶的分布式batch sampler，配合 DataLoader(batch_sampler=...) 使用。
+    先在打乱后的大块(batch_size * bucket_factor)内按源句长度排序切成batch，
+    使同一个batch里的句子长度接近、padding更少；再打乱batch顺序，按rank轮流分配。
+    每个rank得到的batch数相同，避免梯度all_reduce时有进程提前结束而卡住。
+    """
+    def __init__(self, lengths, batch_size, num_replicas=1, rank=0, shuffle=True, seed=0, bucket_factor=100):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_factor = bucket_factor
+        self.epoch = 0
+
+        num_batches = math.ceil(len(lengths) / batch_size)
+        self.num_batches_per_replica = math.ceil(num_batches / num_replicas)
+
+    def set_epoch(self, epoch):
+        # 每个epoch换一种打乱方式，所有rank用同一个种子保证划分一致
+        self.epoch = epoch
+
+    def _batches(self):
+        g = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            g.shuffle(indices)
+
+        chunk_size = self.batch_size * self.bucket_factor
+        batches = []
+        for start in range(0, len(indices), chunk_size):
+            chunk = sorted(indices[start:start+chunk_size], key=lambda i: self.lengths[i])
+            batches.extend(chunk[i:i+self.batch_size] for i in range(0, len(chunk), self.batch_size))
+        if self.shuffle:
+            g.shuffle(batches)
+
+        # 补齐到 num_replicas 的整数倍
+        total = self.num_batches_per_replica * self.num_replicas
+        batches += batches[:total - len(batches)]
+        return batches
+
+    def __iter__(self):
+        return iter(self._batches()[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return self.num_batches_per_replica
+
 """attention model"""
 
+# 性能分析：train(profiler=...)时为True，模型里用profile_region标记各部分的耗时
+# 关闭时profile_region只返回同一个nullcontext，不调用record_function
+PROFILING = False
+_NO_PROFILE = nullcontext()
+
+def profile_region(name, step=None):
+    if not PROFILING:
+        return _NO_PROFILE
+    return torch.profiler.record_function(name if step is None else "%s_%d" % (name, step))
+
+def make_profiler(trace_dir, wait=5, warmup=2, active=5):
+    """
+    跳过wait步、预热warmup步后记录active步，结束时导出Chrome trace
+    (在chrome://tracing或Perfetto里打开)和按self CPU时间排序的算子表
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+
+    def on_trace_ready(prof):
+        name = os.path.join(trace_dir, "rank%d_step%d" % (RANK, prof.step_num))
+        prof.export_chrome_trace(name + ".json")
+        table = prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=30)
+        with open(name + "_top_ops.txt", "w", encoding="utf-8") as f:
+            f.write(table)
+        if RANK == 0:
+            print(table)
+            print("Saved profile to", name + ".json")
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=on_trace_ready,
+        record_shapes=True)
+
 class Encoder(nn.Module):
     def __init__(self, input_dim, emb_dim, hid_dim, n_layers, dropout=0.5, bidirectional=True):
         super(Encoder, self).__init__()
         
         self.hid_dim = hid_dim
         self.n_layers = n_layers
+        self.bidirectional = bidirectional
         
         self.embedding = nn.Embedding(input_dim, emb_dim)
         self.gru = nn.GRU(emb_dim, hid_dim, n_layers, dropout=dropout, bidirectional=bidirectional)
         
-    def forward(self, input_seqs, input_lengths, hidden):
+    def forward(self, input_seqs, input_lengths, hidden=None):
         # input_seqs = [seq_len, batch]
+        # hidden=None时初始隐状态为0
         embedded = self.embedding(input_seqs)
         # embedded = [seq_len, batch, embed_dim]
         packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, input_lengths, enforce_sorted=False)
@@ -135,6 +292,56 @@ class Encoder(nn.Module):
         # output_lengths = [batch]
         return outputs, hidden
 
+class SelfAttnEncoder(nn.Module):
+    """
+    self-attention encoder，所有位置并行计算，可以代替Encoder(GRU)，输出相同:
+        outputs = [seq_len, batch, hid_dim * n_directions]，补齐的位置为0
+        hidden = [n_layers * n_directions, batch, hid_dim]，作为decoder的初始隐状态
+    hidden由有效位置的平均值经过一个线性层得到
+    位置编码只有max_positions个，Seq2Seq.encode()会把更长的输入截断到max_positions
+    """
+    def __init__(self, input_dim, emb_dim, hid_dim, n_layers, dropout=0.1, bidirectional=True, n_heads=8, max_positions=512):
+        super(SelfAttnEncoder, self).__init__()
+
+        self.hid_dim = hid_dim
+        self.n_layers = n_layers
+        self.bidirectional = bidirectional
+        self.n_directions = 2 if bidirectional else 1
+        self.max_positions = max_positions
+        d_model = hid_dim * self.n_directions
+
+        self.embedding = nn.Embedding(input_dim, emb_dim)
+        self.input_proj = nn.Linear(emb_dim, d_model)
+        self.pos_embedding = nn.Embedding(max_positions, d_model)
+        layer = nn.TransformerEncoderLayer(d_model, n_heads, dim_feedforward=2*d_model, dropout=dropout)
+        # 输入不是batch_first，用不上nested tensor，关掉以免每次构建都警告
+        self.layers = nn.TransformerEncoder(layer, n_layers, enable_nested_tensor=False)
+        self.bridge = nn.Linear(d_model, n_layers * self.n_directions * hid_dim)
+
+    def forward(self, input_seqs, input_lengths=None, hidden=None):
+        # input_seqs = [seq_len, batch]；input_lengths=None表示没有补齐；hidden不使用，只为了和Encoder接口一致
+        seq_len, batch_size = input_seqs.shape
+        positions = torch.arange(seq_len, device=input_seqs.device).unsqueeze(1)
+        embedded = self.input_proj(self.embedding(input_seqs)) + self.pos_embedding(positions)
+        # embedded = [seq_len, batch, d_model]
+
+        if input_lengths is None:
+            outputs = self.layers(embedded)
+            pooled = outputs.mean(0)
+        else:
+            lengths = torch.as_tensor(input_lengths, device=input_seqs.device)
+            # padding_mask = [batch, seq_len]，True为补齐的位置
+            padding_mask = torch.arange(seq_len, device=input_seqs.device).unsqueeze(0) >= lengths.unsqueeze(1)
+            outputs = self.layers(embedded, src_key_padding_mask=padding_mask)
+            # 和pad_packed_sequence一样：补齐的位置为0，长度截到batch里最长的句子
+            outputs = outputs.masked_fill(padding_mask.t().unsqueeze(2), 0)[:int(lengths.max())]
+            pooled = outputs.sum(0) / lengths.unsqueeze(1)
+
+        # [batch, n_layers*n_directions*hid_dim] -> [n_layers*n_directions, batch, hid_dim]
+        hidden = torch.tanh(self.bridge(pooled))
+        hidden = hidden.view(batch_size, self.n_layers * self.n_directions, self.hid_dim).transpose(0, 1).contiguous()
+        return outputs, hidden
+
 class Attn(nn.Module):
     def __init__(self, method, hidden_size):
         super(Attn, self).__init__()
@@ -161,9 +368,10 @@ class Attn(nn.Module):
         # energy = [sql_len, batch, hidden_size]
         return torch.sum(self.v * energy, dim=2)  # [seq_len, batch]
 
-    def forward(self, hidden, encoder_outputs):
+    def forward(self, hidden, encoder_outputs, src_mask=None):
         # hidden = [1, batch,  n_directions * hid_dim]
         # encoder_outputs = [seq_len, batch, hid dim * n directions]
+        # src_mask = [batch, seq_len]，False的位置(padding)不参与attention
         if self.method == 'general':
             attn_energies = self.general_score(hidden, encoder_outputs)
         elif self.method == 'concat':
@@ -172,11 +380,14 @@ class Attn(nn.Module):
             attn_energies = self.dot_score(hidden, encoder_outputs)
 
         attn_energies = attn_energies.t()  # [batch, seq_len]
+        if src_mask is not None:
+            attn_energies = attn_energies.masked_fill(~src_mask, float('-inf'))
  
         return F.softmax(attn_energies, dim=1).unsqueeze(1)  # softmax归一化# [batch, 1, seq_len]
 
 class AttnDecoder(nn.Module):
-    def __init__(self, output_dim, emb_dim, hid_dim, n_layers=1, dropout=0.5, bidirectional=True, attn_method="general"):
+    def __init__(self, output_dim, emb_dim, hid_dim, n_layers=1, dropout=0.5, bidirectional=True, attn_method="general",
+                 tie_embeddings=False):
         super(AttnDecoder, self).__init__()
 
         self.output_dim = output_dim
@@ -184,6 +395,7 @@ class AttnDecoder(nn.Module):
         self.hid_dim = hid_dim
         self.n_layers = n_layers
         self.dropout = dropout
+        self.bidirectional = bidirectional
 
         self.embedding = nn.Embedding(output_dim, emb_dim)
         self.embedding_dropout = nn.Dropout(dropout)
@@ -191,15 +403,29 @@ class AttnDecoder(nn.Module):
         
         if bidirectional:
             self.concat = nn.Linear(hid_dim * 2 * 2, hid_dim*2)
-            self.out = nn.Linear(hid_dim*2, output_dim)
             self.attn = Attn(attn_method, hid_dim*2)
         else:
             self.concat = nn.Linear(hid_dim * 2, hid_dim)
-            self.out = nn.Linear(hid_dim, output_dim)
             self.attn = Attn(attn_method, hid_dim)
+        concat_dim = hid_dim * 2 if bidirectional else hid_dim
+
+        # tie_embeddings=True时输出层和embedding共用 [output_dim, emb_dim] 的权重，
+        # concat输出的维度不等于emb_dim时先用out_proj投影到emb_dim
+        self.tie_embeddings = tie_embeddings
+        if tie_embeddings:
+            self.out_proj = nn.Linear(concat_dim, emb_dim, bias=False) if concat_dim != emb_dim else nn.Identity()
+            self.out_bias = nn.Parameter(torch.zeros(output_dim))
+        else:
+            self.out = nn.Linear(concat_dim, output_dim)
         self.softmax = nn.LogSoftmax(dim=1)
 
-    def forward(self, token_inputs, last_hidden, encoder_outputs):
+    def output_logits(self, concat_output):
+        # concat_output = [batch, n_directions*hid_dim] -> [batch, output_dim]
+        if self.tie_embeddings:
+            return F.linear(self.out_proj(concat_output), self.embedding.weight, self.out_bias)
+        return self.out(concat_output)
+
+    def forward(self, token_inputs, last_hidden, encoder_outputs, src_mask=None):
         batch_size = token_inputs.size(0)
         embedded = self.embedding(token_inputs)
         embedded = self.embedding_dropout(embedded)
@@ -210,7 +436,8 @@ class AttnDecoder(nn.Module):
         # hidden = [n_layers * n_directions, batch, hid_dim]
 
         # encoder_outputs = [sql_len, batch, hid dim * n directions]
-        attn_weights = self.attn(gru_output, encoder_outputs)
+        with profile_region("attention"):
+            attn_weights = self.attn(gru_output, encoder_outputs, src_mask)
         # attn_weights = [batch, 1, sql_len]
         context = attn_weights.bmm(encoder_outputs.transpose(0, 1))
         # [batch, 1, hid_dim * n directions]
@@ -221,7 +448,7 @@ class AttnDecoder(nn.Module):
         concat_input = torch.cat((gru_output, context), 1)  # [batch, n_directions * hid_dim * 2]
         concat_output = torch.tanh(self.concat(concat_input))  # [batch, n_directions*hid_dim]
 
-        output = self.out(concat_output)  # [batch, output_dim]
+        output = self.output_logits(concat_output)  # [batch, output_dim]
         output = self.softmax(output)
 
         return output, hidden, attn_weights
@@ -233,7 +460,11 @@ class Seq2Seq(nn.Module):
                  device, 
                  predict=False, 
                  basic_dict=None,
-                 max_len=100
+                 max_len=100,
+                 checkpoint_every=0,
+                 checkpoint_encoder=False,
+                 max_len_ratio=None,
+                 max_len_offset=0
                  ):
         super(Seq2Seq, self).__init__()
         
@@ -245,12 +476,21 @@ class Seq2Seq(nn.Module):
         self.predict = predict  # 训练阶段还是预测阶段
         self.basic_dict = basic_dict  # decoder的字典，存放特殊token对应的id
         self.max_len = max_len  # 翻译时最大输出长度
+        # 每句话的最大输出长度为 min(max_len, ceil(max_len_ratio * 源句长度 + max_len_offset))，
+        # max_len_ratio=None时都用max_len
+        self.max_len_ratio = max_len_ratio
+        self.max_len_offset = max_len_offset
+        # 解码统计：句子数、因达到长度上限而结束(没有输出<eos>)的句子数、decoder步数
+        self.decode_stats = {"sentences": 0, "capped": 0, "decoder_steps": 0}
+        # 激活检查点：训练时不保存中间激活，backward时重新计算，用计算换内存
+        self.checkpoint_every = checkpoint_every  # decoder每多少步一段，0表示不用
+        self.checkpoint_encoder = checkpoint_encoder
 
         assert encoder.hid_dim == decoder.hid_dim, \
             "Hidden dimensions of encoder and decoder must be equal!"
         assert encoder.n_layers == decoder.n_layers, \
             "Encoder and decoder must have equal number of layers!"
-        assert encoder.gru.bidirectional == decoder.gru.bidirectional, \
+        assert encoder.bidirectional == decoder.bidirectional, \
             "Decoder and encoder must had same value of bidirectional attribute!"
         
     def forward(self, input_batches, input_lengths, target_batches=None, target_lengths=None, teacher_forcing_ratio=0.5):
@@ -259,125 +499,339 @@ class Seq2Seq(nn.Module):
         batch_size = input_batches.size(1)
         
         BOS_token = self.basic_dict["<bos>"]
-        EOS_token = self.basic_dict["<eos>"]
         PAD_token = self.basic_dict["<pad>"]
 
-        # 初始化
-        enc_n_layers = self.encoder.gru.num_layers
-        enc_n_directions = 2 if self.encoder.gru.bidirectional else 1
-        encoder_hidden = torch.zeros(enc_n_layers*enc_n_directions, batch_size, self.encoder.hid_dim, device=self.device)
-        
-        # encoder_outputs = [input_lengths, batch, hid_dim * n directions]
-        # encoder_hidden = [n_layers*n_directions, batch, hid_dim]
-        encoder_outputs, encoder_hidden = self.encoder(
-            input_batches, input_lengths, encoder_hidden)
-
-        # 初始化
-        decoder_input = torch.tensor([BOS_token] * batch_size, dtype=torch.long, device=self.device)
-        decoder_hidden = encoder_hidden
-
         if self.predict:
             # 一次只输入一句话
             assert batch_size == 1, "batch_size of predict phase must be 1!"
-            output_tokens = []
-
-            while True:
-                decoder_output, decoder_hidden, decoder_attn = self.decoder(
-                    decoder_input, decoder_hidden, encoder_outputs
-                )
-                # [1, 1]
-                topv, topi = decoder_output.topk(1)
-                decoder_input = topi.squeeze(1).detach()
-                output_token = topi.squeeze().detach().item()
-                if output_token == EOS_token or len(output_tokens) == self.max_len:
-                    break
-                output_tokens.append(output_token)
-            return output_tokens
+            return self.decode(self.encode(input_batches, input_lengths))[0]
 
         else:
+            # 只在需要反向传播时用检查点(evaluate()在no_grad下运行)
+            use_checkpoint = torch.is_grad_enabled()
+
+            # 训练时attention不mask补齐的位置，和原来一致
+            with profile_region("encode"):
+                if use_checkpoint and self.checkpoint_encoder:
+                    encoder_outputs, encoder_hidden, _ = torch.utils.checkpoint.checkpoint(
+                        self.encode, input_batches, input_lengths, use_reentrant=False)
+                else:
+                    encoder_outputs, encoder_hidden, _ = self.encode(input_batches, input_lengths)
+            decoder_input = torch.tensor([BOS_token] * batch_size, dtype=torch.long, device=self.device)
+            decoder_hidden = encoder_hidden
+
             max_target_length = max(target_lengths)
-            all_decoder_outputs = torch.zeros((max_target_length, batch_size, self.decoder.output_dim), device=self.device)
-
-            for t in range(max_target_length):
-                use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
-                if use_teacher_forcing:
-                    # decoder_output = [batch, output_dim]
-                    # decoder_hidden = [n_layers*n_directions, batch, hid_dim]
-                    decoder_output, decoder_hidden, decoder_attn = self.decoder(
-                        decoder_input, decoder_hidden, encoder_outputs
-                    )
-                    all_decoder_outputs[t] = decoder_output
-                    decoder_input = target_batches[t]  # 下一个输入来自训练数据
+            # scheduled sampling：每个token独立决定下一个输入来自训练数据(teacher forcing)还是模型预测
+            # teacher_forcing = [seq_len, batch]
+            teacher_forcing = torch.rand(max_target_length, batch_size, device=self.device) < teacher_forcing_ratio
+
+            checkpoint_decoder = use_checkpoint and self.checkpoint_every > 0
+            # 不用检查点时整个序列是一段
+            segment = self.checkpoint_every if checkpoint_decoder else max_target_length
+            all_decoder_outputs = []
+            for start in range(0, max_target_length, segment):
+                end = min(start + segment, max_target_length)
+                args = (start, end, decoder_input, decoder_hidden, encoder_outputs, target_batches, teacher_forcing)
+                if checkpoint_decoder:
+                    # 每段只保存输入，这一段里每一步的激活在backward时重新计算
+                    outputs, decoder_hidden, decoder_input = torch.utils.checkpoint.checkpoint(
+                        self._decode_steps, *args, use_reentrant=False)
                 else:
-                    decoder_output, decoder_hidden, decoder_attn = self.decoder(
-                        decoder_input, decoder_hidden, encoder_outputs
-                    )
-                    # [batch, 1]
-                    topv, topi = decoder_output.topk(1)
-                    all_decoder_outputs[t] = decoder_output
-                    decoder_input = topi.squeeze(1).detach()  # 下一个输入来自模型预测
+                    outputs, decoder_hidden, decoder_input = self._decode_steps(*args)
+                all_decoder_outputs.append(outputs)
+            # all_decoder_outputs = [seq_len, batch, output_dim]
+            all_decoder_outputs = torch.cat(all_decoder_outputs)
             
-            loss_fn = nn.NLLLoss(ignore_index=PAD_token)
-            loss = loss_fn(
-                all_decoder_outputs.reshape(-1, self.decoder.output_dim),  # [batch*seq_len, output_dim]
-                target_batches.reshape(-1)               # [batch*seq_len]
-            )
+            with profile_region("loss"):
+                loss_fn = nn.NLLLoss(ignore_index=PAD_token)
+                loss = loss_fn(
+                    all_decoder_outputs.reshape(-1, self.decoder.output_dim),  # [batch*seq_len, output_dim]
+                    target_batches.reshape(-1)               # [batch*seq_len]
+                )
             return loss
 
+    def _decode_steps(self, start, end, decoder_input, decoder_hidden, encoder_outputs, target_batches, teacher_forcing):
+        """训练时decoder的第start到end-1步，返回 (这几步的输出, 最后的隐状态, 下一步的输入)"""
+        outputs = []
+        for t in range(start, end):
+            with profile_region("decoder_step", t):
+                # decoder_output = [batch, output_dim]
+                # decoder_hidden = [n_layers*n_directions, batch, hid_dim]
+                decoder_output, decoder_hidden, decoder_attn = self.decoder(
+                    decoder_input, decoder_hidden, encoder_outputs
+                )
+                outputs.append(decoder_output)
+                decoder_input = torch.where(teacher_forcing[t], target_batches[t], decoder_output.argmax(1))
+        return torch.stack(outputs), decoder_hidden, decoder_input
+
+    def encode(self, input_batches, input_lengths):
+        """
+        只运行encoder，返回 encoder_state = (encoder_outputs, encoder_hidden, src_mask)
+        同一个encoder_state可以传给decode()多次(不同的max_len等)，不需要重新encode
+        input_batches = [seq_len, batch]，按input_lengths补齐
+        """
+        # encoder可以是Encoder(GRU)或SelfAttnEncoder，初始隐状态由encoder自己决定
+        # encoder_outputs = [input_lengths, batch, hid_dim * n directions]
+        # encoder_hidden = [n_layers*n_directions, batch, hid_dim]
+        # SelfAttnEncoder只有max_positions个位置，更长的输入截断，不让一句话让整个batch出错
+        max_positions = getattr(self.encoder, "max_positions", None)
+        if max_positions is not None and input_batches.size(0) > max_positions:
+            input_batches = input_batches[:max_positions]
+            input_lengths = [min(length, max_positions) for length in input_lengths]
+        encoder_outputs, encoder_hidden = self.encoder(input_batches, input_lengths)
+        # 补齐的位置不参与attention，否则短句的翻译会受同一batch里长句的影响
+        lengths = torch.tensor(input_lengths, device=self.device)
+        src_mask = torch.arange(encoder_outputs.size(0), device=self.device).unsqueeze(0) < lengths.unsqueeze(1)
+        return encoder_outputs, encoder_hidden, src_mask
+
+    def decode_limits(self, src_lengths, max_len=None):
+        """每句话的最大输出长度，src_lengths = [batch]"""
+        max_len = self.max_len if max_len is None else max_len
+        if self.max_len_ratio is None:
+            return torch.full_like(src_lengths, max_len)
+        limits = torch.ceil(src_lengths * self.max_len_ratio + self.max_len_offset).long()
+        return limits.clamp(1, max_len)
+
+    def decode(self, encoder_state, max_len=None):
+        """
+        从encode()的结果批量贪心解码，不会修改encoder_state
+        返回每句话的输出token列表(不含<eos>)，长度不超过decode_limits()
+        """
+        encoder_outputs, encoder_hidden, src_mask = encoder_state
+        batch_size = encoder_outputs.size(1)
+        limits = self.decode_limits(src_mask.sum(1), max_len)
+
+        BOS_token = self.basic_dict["<bos>"]
+        EOS_token = self.basic_dict["<eos>"]
+
+        decoder_input = torch.full((batch_size,), BOS_token, dtype=torch.long, device=self.device)
+        decoder_hidden = encoder_hidden
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+        capped = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+        steps = []
+        for t in range(int(limits.max())):
+            decoder_output, decoder_hidden, decoder_attn = self.decoder(
+                decoder_input, decoder_hidden, encoder_outputs, src_mask
+            )
+            decoder_input = decoder_output.argmax(1)
+            finished |= decoder_input == EOS_token
+            # 已经结束的句子后面都填<eos>
+            steps.append(decoder_input.masked_fill(finished, EOS_token))
+            # 这一步输出了第limits个token还没有<eos>的句子到此为止
+            capped |= ~finished & (limits <= t + 1)
+            finished |= capped
+            if finished.all():
+                break
+
+        self.decode_stats["sentences"] += batch_size
+        self.decode_stats["capped"] += int(capped.sum())
+        self.decode_stats["decoder_steps"] += len(steps) * batch_size
+
+        output_tokens = torch.stack(steps, 1).tolist() if steps else [[] for _ in range(batch_size)]
+        return [tokens[:tokens.index(EOS_token)] if EOS_token in tokens else tokens for tokens in output_tokens]
+
+    def greedy_decode(self, input_batches, input_lengths, max_len=None):
+        """批量贪心解码，一次翻译多句话(例如翻译服务里的micro-batch)"""
+        return self.decode(self.encode(input_batches, input_lengths), max_len)
+
 """train
 
 """
 
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def broadcast_parameters(model, src=0):
+    # 保证所有rank从同一份初始权重开始
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src)
+
+def average_gradients(model):
+    # 把所有梯度拼成一个buffer做一次all_reduce，比逐个参数通信开销小
+    params = [p for p in model.parameters() if p.requires_grad]
+    grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= dist.get_world_size()
+    offset = 0
+    for p in params:
+        numel = p.numel()
+        p.grad = flat[offset:offset+numel].view_as(p).clone()
+        offset += numel
+
+def all_reduce_mean(value):
+    # 各rank上的标量取平均，单进程时原样返回
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() / dist.get_world_size()
+
+def teacher_forcing_schedule(epoch, start=1.0, end=0.5, decay_epochs=20):
+    if decay_epochs <= 0:
+        return end
+    return start + (end - start) * min(1.0, epoch / decay_epochs)
+
+def decode_length_ratio(src_data, trg_data, quantile=0.99):
+    """语料里 目标长度/源句长度 的quantile分位数，用于按源句长度限制翻译长度"""
+    ratios = sorted(len(trg) / len(src) for src, trg in zip(src_data, trg_data))
+    return ratios[min(len(ratios) - 1, int(quantile * len(ratios)))]
+
 def epoch_time(start_time, end_time):
     elapsed_time = end_time - start_time
     elapsed_mins = int(elapsed_time / 60)
     elapsed_secs = int(elapsed_time - (elapsed_mins * 60))
     return elapsed_mins, elapsed_secs
 
+class WarmupPlateauScheduler:
+    """
+    学习率调度 + 早停:
+    前 warmup_steps 个step学习率线性增加到 base_lr；
+    之后验证loss连续 decay_patience 个epoch没有提升，学习率乘以 decay_factor(不低于 min_lr)；
+    连续 stop_patience 个epoch没有提升则建议停止训练。
+    step() 每个batch调用一次，epoch_end(valid_loss) 每个epoch调用一次。
+    """
+    def __init__(self, optimizer, warmup_steps=0, decay_factor=0.5, decay_patience=3,
+                 min_lr=0., stop_patience=None, min_delta=0.):
+        self.optimizer = optimizer
+        self.base_lrs = [group["lr"] for group in optimizer.param_groups]
+        self.warmup_steps = warmup_steps
+        self.decay_factor = decay_factor
+        self.decay_patience = decay_patience
+        self.min_lr = min_lr
+        self.stop_patience = stop_patience
+        self.min_delta = min_delta
+
+        self.num_steps = 0
+        self.scale = 1.0  # 平台期衰减累计的系数
+        self.best = float('inf')
+        self.num_bad_epochs = 0  # 距上次提升的epoch数
+        self.num_epochs_since_decay = 0
+        self._set_lr()
+
+    def _set_lr(self):
+        warmup = min(1.0, (self.num_steps + 1) / self.warmup_steps) if self.warmup_steps else 1.0
+        for group, base_lr in zip(self.optimizer.param_groups, self.base_lrs):
+            group["lr"] = max(base_lr * self.scale, self.min_lr) * warmup
+
+    def get_lr(self):
+        return [group["lr"] for group in self.optimizer.param_groups]
+
+    def step(self):
+        self.num_steps += 1
+        self._set_lr()
+
+    def epoch_end(self, valid_loss):
+        """返回True表示应当早停"""
+        if valid_loss < self.best - self.min_delta:
+            self.best = valid_loss
+            self.num_bad_epochs = 0
+            self.num_epochs_since_decay = 0
+        else:
+            self.num_bad_epochs += 1
+            self.num_epochs_since_decay += 1
+            if self.num_epochs_since_decay >= self.decay_patience:
+                self.scale *= self.decay_factor
+                self.num_epochs_since_decay = 0
+                self._set_lr()
+        return self.stop_patience is not None and self.num_bad_epochs >= self.stop_patience
+
+    def state_dict(self):
+        return {k: v for k, v in self.__dict__.items() if k != "optimizer"}
+
+    def load_state_dict(self, state_dict):
+        self.__dict__.update(state_dict)
+        self._set_lr()
+
+def save_training_state(path, epoch, model, optimizer, scheduler, best_valid_loss):
+    # 先写临时文件再替换，避免中途被杀掉留下损坏的checkpoint
+    state = {
+        "epoch": epoch,
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "best_valid_loss": best_valid_loss,
+    }
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_training_state(path, model, optimizer, scheduler):
+    # 返回 (下一个epoch, best_valid_loss)
+    state = torch.load(path, map_location=device)
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    scheduler.load_state_dict(state["scheduler"])
+    return state["epoch"] + 1, state["best_valid_loss"]
+
 def train(
     model,
     data_loader, 
     optimizer, 
     clip=1, 
     teacher_forcing_ratio=0.5, 
-    print_every=None  # None不打印
+    print_every=None,  # None不打印
+    scheduler=None,
+    profiler=None  # make_profiler()的返回值，None不做性能分析
     ):
+    global PROFILING
     model.predict = False
     model.train()
 
     if print_every == 0:
         print_every = 1
 
+    if profiler is not None:
+        PROFILING = True
+        profiler.start()
+
     print_loss_total = 0  # 每次打印都重置
     start = time.time()
     epoch_loss = 0
-    for i, batch in enumerate(data_loader):
-
-        # shape = [seq_len, batch]
-        input_batchs = batch["src"]
-        target_batchs = batch["trg"]
-        # list
-        input_lens = batch["src_len"]
-        target_lens = batch["trg_len"]
+    # 中途出错时也要停止profiler并复位PROFILING，否则同一进程里之后的调用会一直记录
+    try:
+        for i, batch in enumerate(data_loader):
+
+            # shape = [seq_len, batch]
+            input_batchs = batch["src"]
+            target_batchs = batch["trg"]
+            # list
+            input_lens = batch["src_len"]
+            target_lens = batch["trg_len"]
         
-        optimizer.zero_grad()
+            optimizer.zero_grad()
         
-        loss = model(input_batchs, input_lens, target_batchs, target_lens, teacher_forcing_ratio)
-        print_loss_total += loss.item()
-        epoch_loss += loss.item()
-        loss.backward()
+            with profile_region("forward"):
+                loss = model(input_batchs, input_lens, target_batchs, target_lens, teacher_forcing_ratio)
+            print_loss_total += loss.item()
+            epoch_loss += loss.item()
+            with profile_region("backward"):
+                loss.backward()
 
-        # 梯度裁剪
-        torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
+            with profile_region("optimizer"):
+                # 多进程时先平均梯度，再裁剪
+                if is_distributed():
+                    average_gradients(model)
 
-        optimizer.step()
+                # 梯度裁剪
+                torch.nn.utils.clip_grad_norm_(model.parameters(), clip)
 
-        if print_every and (i+1) % print_every == 0:
-            print_loss_avg = print_loss_total / print_every
-            print_loss_total = 0
-            print('\tCurrent Loss: %.4f' % print_loss_avg)
+                optimizer.step()
+                if scheduler is not None:
+                    scheduler.step()
+            if profiler is not None:
+                profiler.step()
 
-    return epoch_loss / len(data_loader)
+            if print_every and (i+1) % print_every == 0:
+                print_loss_avg = print_loss_total / print_every
+                print_loss_total = 0
+                if RANK == 0:
+                    print('\tCurrent Loss: %.4f' % print_loss_avg)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            PROFILING = False
+
+    return all_reduce_mean(epoch_loss / len(data_loader))
 
 def evaluate(
     model,
@@ -409,9 +863,10 @@ def evaluate(
             if print_every and (i+1) % print_every == 0:
                 print_loss_avg = print_loss_total / print_every
                 print_loss_total = 0
-                print('\tCurrent Loss: %.4f' % print_loss_avg)
+                if RANK == 0:
+                    print('\tCurrent Loss: %.4f' % print_loss_avg)
 
-    return epoch_loss / len(data_loader)
+    return all_reduce_mean(epoch_loss / len(data_loader))
 
 def translate(
     model,
@@ -429,7 +884,18 @@ def translate(
     output_tokens = model(input_batch, input_len)
     output_tokens = [idx2token[t] for t in output_tokens]
 
-    return "".join(output_tokens)
+    return detokenize(output_tokens)
+
+def translate_batch(
+    model,
+    batch,
+    idx2token=None
+    ):
+    # batch = {"src": [seq_len, batch], "src_len": list}，返回每句话的翻译
+    model.eval()
+    with torch.no_grad():
+        output_tokens = model.greedy_decode(batch["src"], batch["src_len"])
+    return [detokenize([idx2token[t] for t in tokens]) for tokens in output_tokens]
 
 INPUT_DIM = len(en2id)
 OUTPUT_DIM = len(ch2id)
@@ -444,74 +910,187 @@ DEC_DROPOUT = 0.5
 LEARNING_RATE = 1e-4
 N_EPOCHS = 200
 CLIP = 1
+# 学习率调度与早停(参考codelab.py中SetupRNMTParams的lr_warmup_steps等)
+LR_WARMUP_STEPS = 500
+LR_DECAY_FACTOR = 0.5
+LR_DECAY_PATIENCE = 3  # 验证loss连续3个epoch不下降就衰减学习率
+LR_MIN = 1e-6
+EARLY_STOP_PATIENCE = 10  # 连续10个epoch不下降就停止训练
+MIN_DELTA = 1e-4
+# scheduled sampling：teacher forcing的比例在TF_DECAY_EPOCHS个epoch里从TF_RATIO_START线性降到TF_RATIO_END
+TF_RATIO_START = 1.0
+TF_RATIO_END = 0.5
+TF_DECAY_EPOCHS = 20
+# 激活检查点(内存不够时打开)：decoder每CHECKPOINT_EVERY步重新计算一次，0表示不用；
+# CHECKPOINT_ENCODER同时对encoder做检查点。内存和速度的对比见checkpoint_report.py
+CHECKPOINT_EVERY = 0
+CHECKPOINT_ENCODER = False
+# 翻译长度上限：min(100, ceil(源句长度 * 语料里目标/源长度比的MAX_LEN_QUANTILE分位数 + MAX_LEN_OFFSET))
+MAX_LEN_QUANTILE = 0.99
+MAX_LEN_OFFSET = 5
+
+# encoder类型："gru" 为原来的Encoder；"self_attention" 为SelfAttnEncoder，所有位置并行计算
+# 两者的比较见encoder_benchmark.py
+ENCODER_TYPE = "gru"
+SELF_ATTN_HEADS = 8
+SELF_ATTN_DROPOUT = 0.1
+# decoder的embedding和输出层共用权重，词表大小的参数只保存一份，对比见tied_embedding_report.py
+TIE_EMBEDDINGS = False
+
+MODEL_PATH = "en2ch-attn-model.pt"  # 最优模型权重
+TRAIN_STATE_PATH = "en2ch-attn-model.state.pt"  # 断点续训用的完整训练状态
+if ENCODER_TYPE != "gru":
+    # 不同encoder的权重不能互相加载
+    MODEL_PATH = MODEL_PATH.replace(".pt", "-%s.pt" % ENCODER_TYPE)
+    TRAIN_STATE_PATH = TRAIN_STATE_PATH.replace(".state.pt", "-%s.state.pt" % ENCODER_TYPE)
+if TOKENIZATION == "subword":
+    # 子词模型的词典和embedding大小都和字符模型不同
+    MODEL_PATH = MODEL_PATH.replace(".pt", "-subword.pt")
+    TRAIN_STATE_PATH = TRAIN_STATE_PATH.replace(".state.pt", "-subword.state.pt")
+if TIE_EMBEDDINGS:
+    # 共享权重的模型没有decoder.out，保存在单独的文件里
+    MODEL_PATH = MODEL_PATH.replace(".pt", "-tied.pt")
+    TRAIN_STATE_PATH = TRAIN_STATE_PATH.replace(".state.pt", "-tied.state.pt")
+RESUME = True
+# 性能分析：第一个epoch里跳过PROFILE_WAIT步、预热PROFILE_WARMUP步后记录PROFILE_ACTIVE步，
+# trace和算子表保存在PROFILE_DIR
+PROFILE = False
+PROFILE_WAIT = 5
+PROFILE_WARMUP = 2
+PROFILE_ACTIVE = 5
+PROFILE_DIR = "profile"
 
 bidirectional = True
 attn_method = "general"
-enc = Encoder(INPUT_DIM, ENC_EMB_DIM, HID_DIM, N_LAYERS, ENC_DROPOUT, bidirectional)
-dec = AttnDecoder(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM, N_LAYERS, DEC_DROPOUT, bidirectional, attn_method)
-model = Seq2Seq(enc, dec, device, basic_dict=basic_dict).to(device)
+if ENCODER_TYPE == "self_attention":
+    enc = SelfAttnEncoder(INPUT_DIM, ENC_EMB_DIM, HID_DIM, N_LAYERS, SELF_ATTN_DROPOUT, bidirectional, SELF_ATTN_HEADS)
+else:
+    enc = Encoder(INPUT_DIM, ENC_EMB_DIM, HID_DIM, N_LAYERS, ENC_DROPOUT, bidirectional)
+dec = AttnDecoder(OUTPUT_DIM, DEC_EMB_DIM, HID_DIM, N_LAYERS, DEC_DROPOUT, bidirectional, attn_method,
+                  tie_embeddings=TIE_EMBEDDINGS)
+model = Seq2Seq(enc, dec, device, basic_dict=basic_dict,
+                checkpoint_every=CHECKPOINT_EVERY, checkpoint_encoder=CHECKPOINT_ENCODER,
+                max_len_ratio=decode_length_ratio(en_num_data, ch_num_data, MAX_LEN_QUANTILE),
+                max_len_offset=MAX_LEN_OFFSET).to(device)
+if is_distributed():
+    broadcast_parameters(model)
 
 optimizer = optim.Adam(model.parameters(), lr=LEARNING_RATE)
+scheduler = WarmupPlateauScheduler(
+    optimizer, warmup_steps=LR_WARMUP_STEPS, decay_factor=LR_DECAY_FACTOR,
+    decay_patience=LR_DECAY_PATIENCE, min_lr=LR_MIN,
+    stop_patience=EARLY_STOP_PATIENCE, min_delta=MIN_DELTA)
+
+
+
+# 以下为训练和测试流程，import本脚本(例如其他工具复用模型定义)时不执行
+if __name__ == "__main__":
+    # 数据集
+    train_set = TranslationDataset(en_num_data, ch_num_data)
+    if is_distributed():
+        # 每个rank只训练自己那一份数据，BATCH_SIZE是单个进程的batch大小
+        train_sampler = BucketDistributedSampler(
+            [len(line) for line in en_num_data], BATCH_SIZE,
+            num_replicas=WORLD_SIZE, rank=RANK, seed=seed)
+        train_loader = DataLoader(train_set, batch_sampler=train_sampler, collate_fn=padding_batch)
+    else:
+        train_sampler = None
+        train_loader = DataLoader(train_set, batch_size=BATCH_SIZE, collate_fn=padding_batch)
+    # 每个rank都在整个验证集上算loss，所以早停的判断一致；HOLDOUT = 0时退回用训练数据
+    if valid_en_num_data:
+        valid_loader = DataLoader(TranslationDataset(valid_en_num_data, valid_ch_num_data),
+                                  batch_size=BATCH_SIZE, collate_fn=padding_batch)
+    else:
+        valid_loader = train_loader
+
+    best_valid_loss = float('inf')
+    start_epoch = 0
+    if RESUME and os.path.exists(TRAIN_STATE_PATH):
+        start_epoch, best_valid_loss = load_training_state(TRAIN_STATE_PATH, model, optimizer, scheduler)
+        if RANK == 0:
+            print(f'Resume from epoch {start_epoch+1:02} | Best Val. Loss: {best_valid_loss:.3f}')
+
+    for epoch in range(start_epoch, N_EPOCHS):
+
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        start_time = time.time()
+        profiler = None
+        if PROFILE and epoch == start_epoch:
+            profiler = make_profiler(PROFILE_DIR, PROFILE_WAIT, PROFILE_WARMUP, PROFILE_ACTIVE)
+        teacher_forcing_ratio = teacher_forcing_schedule(epoch, TF_RATIO_START, TF_RATIO_END, TF_DECAY_EPOCHS)
+        train_loss = train(model, train_loader, optimizer, CLIP, teacher_forcing_ratio,
+                           scheduler=scheduler, profiler=profiler)
+        valid_loss = evaluate(model, valid_loader)
+        end_time = time.time()
+
+        # 所有rank的valid_loss相同，所以早停的判断也一致
+        should_stop = scheduler.epoch_end(valid_loss)
+        if valid_loss < best_valid_loss:
+            best_valid_loss = valid_loss
+            # 只有rank 0保存checkpoint
+            if RANK == 0:
+                torch.save(model.state_dict(), MODEL_PATH)
+        if RANK == 0:
+            save_training_state(TRAIN_STATE_PATH, epoch, model, optimizer, scheduler, best_valid_loss)
+
+        if epoch %2 == 0 and RANK == 0:
+            epoch_mins, epoch_secs = epoch_time(start_time, end_time)
+            print(f'Epoch: {epoch+1:02} | Time: {epoch_mins}m {epoch_secs}s')
+            print(f'\tTrain Loss: {train_loss:.3f} | Val. Loss: {valid_loss:.3f} | LR: {scheduler.get_lr()[0]:.2e} | TF: {teacher_forcing_ratio:.2f}')
+
+        if should_stop:
+            if RANK == 0:
+                print(f'Early stopping at epoch {epoch+1:02}: no improvement for {scheduler.num_bad_epochs} epochs')
+            break
+
+    if is_distributed():
+        # 测试只在rank 0上做
+        dist.barrier()
+        dist.destroy_process_group()
+        if RANK != 0:
+            raise SystemExit(0)
+
+    print("best valid loss：", best_valid_loss)
+    # 加载最优权重
+    # model.load_state_dict(torch.load("en2ch-attn-model.pt"))
+
+    model.load_state_dict(torch.load(MODEL_PATH))
+
+    """load test data
 
+    """
 
 
-# 数据集
-train_set = TranslationDataset(en_num_data, ch_num_data)
-train_loader = DataLoader(train_set, batch_size=BATCH_SIZE, collate_fn=padding_batch)
-
-best_valid_loss = float('inf')
-
-for epoch in range(N_EPOCHS):
-    
-    start_time = time.time()
-    train_loss = train(model, train_loader, optimizer, CLIP)
-    valid_loss = evaluate(model, train_loader)
-    end_time = time.time()
-    
-    if valid_loss < best_valid_loss:
-        best_valid_loss = valid_loss
-        torch.save(model.state_dict(), "en2ch-attn-model.pt")
-
-    if epoch %2 == 0:
-        epoch_mins, epoch_secs = epoch_time(start_time, end_time)
-        print(f'Epoch: {epoch+1:02} | Time: {epoch_mins}m {epoch_secs}s')
-        print(f'\tTrain Loss: {train_loss:.3f} | Val. Loss: {valid_loss:.3f}')
-
-print("best valid loss：", best_valid_loss)
-# 加载最优权重
-# model.load_state_dict(torch.load("en2ch-attn-model.pt"))
-
-model.load_state_dict(torch.load("en2ch-attn-model.pt"))
-
-"""load test data
-
-"""
 
+    random.seed(seed)
 
+    from tqdm import tqdm
 
-random.seed(seed)
+    file1=open("Result_onelayer.txt","w",encoding='utf-8')
 
-from tqdm import tqdm
+    for i in random.sample(range(len(en_num_data)),len(en_num_data)):  
+        en_tokens = list(filter(lambda x: x!=0, en_num_data[i]))  # 过滤零
+        ch_tokens = list(filter(lambda x: x!=3 and x!=0, ch_num_data[i]))  # 和机器翻译作对照
+        sentence = [id2en[t] for t in en_tokens]
+        print("【原文】")
+        print(detokenize(sentence))
+        translation = [id2ch[t] for t in ch_tokens]
+        print("【原文】")
+        print(detokenize(translation))
+        test_sample = {}
+        test_sample["src"] = torch.tensor(en_tokens, dtype=torch.long, device=device).reshape(-1, 1)
+        test_sample["src_len"] = [len(en_tokens)]
 
-file1=open("Result_onelayer.txt","w",encoding='utf-8')
+        # 只翻译一次，写文件和打印共用结果
+        machine_translation = translate(model, test_sample, id2ch)
+        file1.writelines(machine_translation)
+        file1.writelines("\n")
+        print("【机器翻译】")
+        print(machine_translation, end="\n\n")
 
-for i in random.sample(range(len(en_num_data)),len(en_num_data)):  
-    en_tokens = list(filter(lambda x: x!=0, en_num_data[i]))  # 过滤零
-    ch_tokens = list(filter(lambda x: x!=3 and x!=0, ch_num_data[i]))  # 和机器翻译作对照
-    sentence = [id2en[t] for t in en_tokens]
-    print("【原文】")
-    print("".join(sentence))
-    translation = [id2ch[t] for t in ch_tokens]
-    print("【原文】")
-    print("".join(translation))
-    test_sample = {}
-    test_sample["src"] = torch.tensor(en_tokens, dtype=torch.long, device=device).reshape(-1, 1)
-    test_sample["src_len"] = [len(en_tokens)]
-    
-    file1.writelines(translate(model, test_sample, id2ch))
-    file1.writelines("\n")
-    print("【机器翻译】")
-    print(translate(model, test_sample, id2ch), end="\n\n")
-    
-file1.close()
+    file1.close()
+    stats = model.decode_stats
+    print(f'{stats["capped"]}/{stats["sentences"]} translations hit the length limit, '
+          f'{stats["decoder_steps"] / max(1, stats["sentences"]):.1f} decoder steps per sentence')
 
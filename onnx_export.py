@@ -0,0 +1,217 @@
+"""
+把Seq2Seq导出成两个ONNX模型，用onnxruntime在CPU上推理。
+
+    encoder:      src [src_len, batch] -> encoder_outputs [src_len, batch, n_directions*hid_dim],
+                                          encoder_hidden [n_layers*n_directions, batch, hid_dim]
+    decoder step: token [batch], hidden, encoder_outputs -> log_probs [batch, output_dim], hidden
+
+decoder只导出一步，隐状态和encoder_outputs都是显式的输入输出，贪心解码的循环在Python里。
+导出的文件放在checkpoint旁边，例如 en2ch-attn-model-encoder.onnx / en2ch-attn-model-decoder_step.onnx:
+
+    python onnx_export.py --layers 1
+    python onnx_export.py --layers 1 --compare --num_samples 500
+
+导出后用另一个长度的句子在onnxruntime和eager上各跑一次encoder和一步decoder，结果不一致时报错，
+确认src_len确实是动态的维度而不是被固定成了导出时的长度。
+
+OnnxBackend 和 Seq2Seq 的predict阶段接口相同，可以直接传给脚本里的 translate()。
+用的是TorchScript导出器(dynamo=False)，需要 torch>=2.5(更早的版本没有dynamo参数)，
+以及 pip install onnx onnxruntime。
+"""
+
+import argparse
+import math
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import bleu
+import model_loader
+import thread_settings
+
+
+class EncoderForExport(nn.Module):
+    """
+    GRU的Encoder去掉pack_padded_sequence(ONNX导出不支持)，对没有补齐的单句输入结果相同；
+    SelfAttnEncoder按没有补齐的输入导出
+    """
+    def __init__(self, encoder):
+        super(EncoderForExport, self).__init__()
+        self.encoder = encoder
+
+    def forward(self, src):
+        if hasattr(self.encoder, "gru"):
+            return self.encoder.gru(self.encoder.embedding(src))
+        return self.encoder(src)
+
+
+class DecoderStep(nn.Module):
+    def __init__(self, decoder):
+        super(DecoderStep, self).__init__()
+        self.decoder = decoder
+
+    def forward(self, token, hidden, encoder_outputs):
+        output, hidden, _ = self.decoder(token, hidden, encoder_outputs)
+        return output, hidden
+
+
+def onnx_paths(model_path):
+    root, _ = os.path.splitext(model_path)
+    return root + "-encoder.onnx", root + "-decoder_step.onnx"
+
+
+def export(n_layers, checkpoint=None, opset_version=13):
+    """
+    导出encoder和decoder step并用check_export()检查，返回两个文件的路径。
+    dynamic_axes只对TorchScript导出器有效，torch>=2.9默认的dynamo导出器要的是dynamic_shapes，
+    所以显式传 dynamo=False
+    """
+    script, model = model_loader.load_model(n_layers, checkpoint, device="cpu")
+    encoder_path, decoder_path = onnx_paths(checkpoint or script.MODEL_PATH)
+
+    src = torch.tensor(model_loader.source_ids(script, "Hello world."), dtype=torch.long).reshape(-1, 1)
+    with torch.no_grad():
+        encoder_outputs, encoder_hidden = EncoderForExport(model.encoder)(src)
+        torch.onnx.export(
+            EncoderForExport(model.encoder), (src,), encoder_path,
+            input_names=["src"], output_names=["encoder_outputs", "encoder_hidden"],
+            dynamic_axes={"src": {0: "src_len", 1: "batch"},
+                          "encoder_outputs": {0: "src_len", 1: "batch"},
+                          "encoder_hidden": {1: "batch"}},
+            opset_version=opset_version, dynamo=False)
+
+        token = torch.tensor([script.basic_dict["<bos>"]], dtype=torch.long)
+        torch.onnx.export(
+            DecoderStep(model.decoder), (token, encoder_hidden, encoder_outputs), decoder_path,
+            input_names=["token", "hidden", "encoder_outputs"], output_names=["log_probs", "next_hidden"],
+            dynamic_axes={"token": {0: "batch"},
+                          "hidden": {1: "batch"},
+                          "encoder_outputs": {0: "src_len", 1: "batch"},
+                          "log_probs": {0: "batch"},
+                          "next_hidden": {1: "batch"}},
+            opset_version=opset_version, dynamo=False)
+    check_export(script, model, encoder_path, decoder_path)
+    return encoder_path, decoder_path
+
+
+def check_export(script, model, encoder_path, decoder_path, sentence="A man in a blue shirt is standing on a ladder.",
+                 atol=1e-4):
+    """
+    用和导出时长度不同的句子比较onnxruntime和eager的encoder输出和第一步decoder输出，
+    不一致(包括src_len被固定而报错)时抛出AssertionError
+    """
+    backend = OnnxBackend(encoder_path, decoder_path, script.basic_dict)
+    src = torch.tensor(model_loader.source_ids(script, sentence), dtype=torch.long).reshape(-1, 1)
+    token = torch.tensor([script.basic_dict["<bos>"]], dtype=torch.long)
+    with torch.no_grad():
+        encoder_outputs, hidden = EncoderForExport(model.encoder)(src)
+        log_probs, next_hidden = DecoderStep(model.decoder)(token, hidden, encoder_outputs)
+    onnx_encoder_outputs, onnx_hidden = backend.encoder.run(None, {"src": src.numpy()})
+    onnx_log_probs, onnx_next_hidden = backend.decoder.run(
+        None, {"token": token.numpy(), "hidden": onnx_hidden, "encoder_outputs": onnx_encoder_outputs})
+    for name, actual, expected in [("encoder_outputs", onnx_encoder_outputs, encoder_outputs),
+                                   ("encoder_hidden", onnx_hidden, hidden),
+                                   ("log_probs", onnx_log_probs, log_probs),
+                                   ("next_hidden", onnx_next_hidden, next_hidden)]:
+        np.testing.assert_allclose(actual, expected.numpy(), atol=atol,
+                                   err_msg="%s differs at src_len=%d" % (name, src.size(0)))
+
+
+class OnnxBackend:
+    """
+    onnxruntime推理后端，调用方式和predict阶段的Seq2Seq相同:
+        translate(OnnxBackend(...), sample, id2ch)
+    """
+    def __init__(self, encoder_path, decoder_path, basic_dict, max_len=100, num_threads=None,
+                 max_len_ratio=None, max_len_offset=0):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("OnnxBackend requires onnxruntime: pip install onnxruntime")
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.encoder = onnxruntime.InferenceSession(encoder_path, options, providers=providers)
+        self.decoder = onnxruntime.InferenceSession(decoder_path, options, providers=providers)
+        self.basic_dict = basic_dict
+        self.max_len = max_len
+        # 和Seq2Seq.decode_limits()相同的长度上限
+        self.max_len_ratio = max_len_ratio
+        self.max_len_offset = max_len_offset
+        self.predict = True
+        self.device = torch.device("cpu")
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_batches, input_lengths):
+        assert input_batches.size(1) == 1, "batch_size of predict phase must be 1!"
+        BOS_token = self.basic_dict["<bos>"]
+        EOS_token = self.basic_dict["<eos>"]
+
+        encoder_outputs, hidden = self.encoder.run(None, {"src": input_batches.cpu().numpy()})
+        token = np.array([BOS_token], dtype=np.int64)
+        max_len = self.max_len
+        if self.max_len_ratio is not None:
+            max_len = max(1, min(max_len, math.ceil(input_lengths[0] * self.max_len_ratio + self.max_len_offset)))
+        output_tokens = []
+        for _ in range(max_len):
+            log_probs, hidden = self.decoder.run(
+                None, {"token": token, "hidden": hidden, "encoder_outputs": encoder_outputs})
+            token = log_probs.argmax(1)
+            if token[0] == EOS_token:
+                break
+            output_tokens.append(int(token[0]))
+        return output_tokens
+
+
+def load_backend(n_layers, checkpoint=None, num_threads=None):
+    script = model_loader.load_script(n_layers)
+    encoder_path, decoder_path = onnx_paths(checkpoint or script.MODEL_PATH)
+    model = script.model
+    return script, OnnxBackend(encoder_path, decoder_path, script.basic_dict, model.max_len, num_threads,
+                               model.max_len_ratio, model.max_len_offset)
+
+
+def compare(n_layers, num_samples, data_path=None, checkpoint=None):
+    script, model = model_loader.load_model(n_layers, checkpoint, device="cpu")
+    _, backend = load_backend(n_layers, checkpoint, torch.get_num_threads())
+    pairs = model_loader.eval_pairs(script, data_path)[:num_samples]
+    references = [trg for _, trg in pairs]
+
+    results = [(name, *model_loader.evaluate_model(script, m, pairs)) for name, m in [("eager", model), ("onnx", backend)]]
+    same = sum(a == b for a, b in zip(results[0][1], results[1][1]))
+    print(f'{len(pairs)} sentences, {n_layers} layer(s), {torch.get_num_threads()} threads, '
+          f'{same} identical translations')
+    print('%-6s %10s %10s %10s %8s %8s' % ('model', 'mean(ms)', 'p50(ms)', 'p90(ms)', 'BLEU', 'speedup'))
+    base = sum(results[0][2]) / len(results[0][2])
+    for name, hypotheses, latencies in results:
+        mean = sum(latencies) / len(latencies)
+        print('%-6s %10.2f %10.2f %10.2f %8.2f %7.2fx' % (
+            name, 1000 * mean, 1000 * model_loader.percentile(latencies, 50),
+            1000 * model_loader.percentile(latencies, 90),
+            bleu.corpus_bleu(references, hypotheses), base / mean))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ONNX export and onnxruntime backend for Seq2Seq")
+    parser.add_argument("--layers", type=int, default=1, choices=sorted(model_loader.LAYER_SCRIPTS))
+    parser.add_argument("--checkpoint", default=None, help="默认为脚本的MODEL_PATH")
+    parser.add_argument("--opset", type=int, default=13)
+    parser.add_argument("--compare", action="store_true", help="比较eager和onnxruntime的延迟")
+    parser.add_argument("--num_samples", type=int, default=500)
+    parser.add_argument("--data", default=None, help="默认为脚本留出的holdout_pairs")
+    args = parser.parse_args()
+
+    thread_settings.apply("translate")
+    for path in export(args.layers, args.checkpoint, args.opset):
+        print("Saved", path)
+    if args.compare:
+        compare(args.layers, args.num_samples, args.data, args.checkpoint)
+
+
+if __name__ == "__main__":
+    main()
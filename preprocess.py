@@ -0,0 +1,209 @@
+"""
+平行语料预处理：多进程去重、按长度和长度比过滤，结果缓存下来给训练脚本复用。
+
+    python preprocess.py --input newdata --max_len 150 --max_ratio 3.0 --workers 4
+
+输出(以 --input newdata 为例):
+    newdata.clean       清洗后的语料，格式和newdata相同(英文\\t德文)
+    newdata.clean.idx   每行一条: 原始行号\\t在newdata.clean里的字节偏移，IndexedCorpus据此随机读取任意一行
+    newdata.stats.json  各类被过滤的句子数、长度直方图、字符频数，以及生成时的参数和输入文件信息
+
+训练脚本直接运行时用 preprocess_subprocess() 在单独的进程里更新过期的缓存(进程池不会重新执行训练脚本)，
+load_corpus() 只读缓存，缓存不存在或过期时在当前进程里过滤，不写文件。
+长度按字符计算(不含<eos>)。
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+
+STATS_VERSION = 1
+
+
+def output_paths(input_path):
+    root, _ = os.path.splitext(input_path)
+    return input_path + ".clean", input_path + ".clean.idx", root + ".stats.json"
+
+
+def normalize(text):
+    return " ".join(text.split())
+
+
+def _process_chunk(args):
+    """worker: 解析、规范化并检查一段行，返回 [(原始行号, 状态, hash, 英文, 德文), ...]"""
+    start, lines, max_len, max_ratio = args
+    results = []
+    for i, line in enumerate(lines):
+        columns = line.split('\t')
+        if len(columns) < 2:
+            results.append((start + i, "malformed", None, None, None))
+            continue
+        src, trg = normalize(columns[0]), normalize(columns[1])
+        if not src or not trg:
+            status = "empty"
+        elif len(src) > max_len or len(trg) > max_len:
+            status = "too_long"
+        elif max(len(src), len(trg)) / min(len(src), len(trg)) > max_ratio:
+            status = "bad_ratio"
+        else:
+            status = "ok"
+        digest = hashlib.sha1((src + '\t' + trg).encode('utf-8')).hexdigest()
+        results.append((start + i, status, digest, src, trg))
+    return results
+
+
+def _file_info(path):
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _histogram(lengths):
+    return {str(k): v for k, v in sorted(collections.Counter(lengths).items())}
+
+
+def _read_lines(input_path):
+    with open(input_path, 'r', encoding='utf-8') as f:
+        return f.read().strip().split('\n')
+
+
+def _filter(lines, max_len, max_ratio, workers=None, chunk_size=2000):
+    """返回 (各类被过滤的句子数, 保留的[(原始行号, 英文, 德文), ...])，workers=0时不开进程池"""
+    chunks = [(i, lines[i:i+chunk_size], max_len, max_ratio) for i in range(0, len(lines), chunk_size)]
+    if workers == 0:
+        results = map(_process_chunk, chunks)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_process_chunk, chunks)
+
+    counts = collections.Counter()
+    seen = set()
+    kept = []
+    for chunk in results:
+        for line_no, status, digest, src, trg in chunk:
+            # 去重在主进程里按原始顺序做，保留第一次出现的句对
+            if status == "ok" and digest in seen:
+                status = "duplicate"
+            counts[status] += 1
+            if status == "ok":
+                seen.add(digest)
+                kept.append((line_no, src, trg))
+    del counts["ok"]
+    return counts, kept
+
+
+def preprocess(input_path, max_len=150, max_ratio=3.0, workers=None, chunk_size=2000):
+    """预处理input_path，写出清洗后的语料、索引和统计文件，返回统计信息"""
+    lines = _read_lines(input_path)
+    counts, kept = _filter(lines, max_len, max_ratio, workers, chunk_size)
+
+    clean_path, index_path, stats_path = output_paths(input_path)
+    offset = 0
+    with open(clean_path, 'w', encoding='utf-8') as clean, open(index_path, 'w', encoding='utf-8') as index:
+        for line_no, src, trg in kept:
+            line = src + '\t' + trg + '\n'
+            clean.write(line)
+            index.write('%d\t%d\n' % (line_no, offset))
+            offset += len(line.encode('utf-8'))
+
+    stats = {
+        "version": STATS_VERSION,
+        "input": _file_info(input_path),
+        "params": {"max_len": max_len, "max_ratio": max_ratio},
+        "counts": dict(counts, input=len(lines), kept=len(kept)),
+        "src_length_histogram": _histogram(len(src) for _, src, _ in kept),
+        "trg_length_histogram": _histogram(len(trg) for _, _, trg in kept),
+        "src_vocab": dict(collections.Counter(char for _, src, _ in kept for char in src).most_common()),
+        "trg_vocab": dict(collections.Counter(char for _, _, trg in kept for char in trg).most_common()),
+    }
+    # 统计文件最后写，它存在就说明上面的文件都写完了
+    with open(stats_path, 'w', encoding='utf-8') as f:
+        json.dump(stats, f, ensure_ascii=False, indent=1)
+    return stats
+
+
+def load_stats(input_path, max_len=150, max_ratio=3.0):
+    """缓存有效时返回统计信息，否则返回None"""
+    clean_path, index_path, stats_path = output_paths(input_path)
+    if not all(os.path.exists(path) for path in (clean_path, index_path, stats_path)):
+        return None
+    with open(stats_path, 'r', encoding='utf-8') as f:
+        stats = json.load(f)
+    if (stats.get("version") != STATS_VERSION or stats["input"] != _file_info(input_path)
+            or stats["params"] != {"max_len": max_len, "max_ratio": max_ratio}):
+        return None
+    return stats
+
+
+def preprocess_subprocess(input_path, max_len=150, max_ratio=3.0, workers=None):
+    """
+    缓存过期时在单独的进程里运行本脚本预处理，返回是否重新预处理了。
+    进程池属于那个进程，在spawn/forkserver下worker也不会重新执行调用方的脚本
+    """
+    if load_stats(input_path, max_len, max_ratio) is not None:
+        return False
+    command = [sys.executable, os.path.abspath(__file__), "--input", input_path,
+               "--max_len", str(max_len), "--max_ratio", str(max_ratio)]
+    if workers is not None:
+        command += ["--workers", str(workers)]
+    subprocess.run(command, check=True)
+    return True
+
+
+def load_corpus(input_path, max_len=150, max_ratio=3.0):
+    """
+    返回清洗后的语料(和读newdata一样的行列表)。只读缓存：缓存不存在或过期时
+    在当前进程里过滤(不开进程池)，不写任何文件
+    """
+    if load_stats(input_path, max_len, max_ratio) is None:
+        _, kept = _filter(_read_lines(input_path), max_len, max_ratio, workers=0)
+        return [src + '\t' + trg for _, src, trg in kept]
+    with open(output_paths(input_path)[0], 'r', encoding='utf-8') as f:
+        return f.read().rstrip('\n').split('\n')
+
+
+class IndexedCorpus:
+    """
+    随机读取清洗后的语料：索引只在创建时读一次，corpus[i] 按字节偏移seek，
+    返回 (原始行号, 英文, 德文)
+    """
+    def __init__(self, input_path):
+        clean_path, index_path, _ = output_paths(input_path)
+        with open(index_path, 'r', encoding='utf-8') as f:
+            entries = [tuple(map(int, line.split('\t'))) for line in f]
+        self.line_numbers = [line_no for line_no, _ in entries]
+        self.offsets = [offset for _, offset in entries]
+        self.file = open(clean_path, 'rb')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        self.file.seek(self.offsets[i])
+        src, trg = self.file.readline().decode('utf-8').rstrip('\n').split('\t')
+        return self.line_numbers[i], src, trg
+
+    def close(self):
+        self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dedup and length filtering for newdata-style corpora")
+    parser.add_argument("--input", default="newdata")
+    parser.add_argument("--max_len", type=int, default=150, help="最大字符数")
+    parser.add_argument("--max_ratio", type=float, default=3.0, help="两边字符数之比的上限")
+    parser.add_argument("--workers", type=int, default=None, help="默认为CPU核数")
+    args = parser.parse_args()
+
+    stats = preprocess(args.input, args.max_len, args.max_ratio, args.workers)
+    for key, value in sorted(stats["counts"].items()):
+        print('%-10s %8d' % (key, value))
+    print('Wrote', ', '.join(output_paths(args.input)))
+
+
+if __name__ == "__main__":
+    main()
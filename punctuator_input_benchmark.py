@@ -0,0 +1,129 @@
+"""Benchmarks the PunctuatorInput pipeline in input examples/sec.
+
+Compares the legacy tf.py_func normalizer against the native tf.strings one,
+and the two-pass source tokenization against the "derive" and "cache" modes, on
+the codelab training text. Before timing it checks that both normalizers agree
+and reports how often derived source ids match the exact ones:
+
+  python punctuator_input_benchmark.py --steps=200
+"""
+
+import os
+import time
+
+from absl import app
+from absl import flags
+import lingvo.compat as tf
+
+import codelab
+import input_generator
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('steps', 100, 'Number of batches to time per setting.')
+flags.DEFINE_integer('warmup_steps', 10,
+                     'Number of batches to run before timing each setting.')
+flags.DEFINE_integer('check_lines', 10000,
+                     'Number of lines to compare the two normalizers on.')
+
+
+def _TextFilePattern():
+  return os.path.join(codelab.RNMTModel._DataDir(),
+                      codelab.RNMTModel._TRAIN_FILES)
+
+
+def _Settings():
+  """Returns (name, input params) pairs to benchmark."""
+  base = codelab.RNMTModel().Train()
+  # Always read the raw text; pre-tokenized shards would skip normalization.
+  base.file_pattern = 'text:' + _TextFilePattern()
+  base.file_parallelism = codelab._FileParallelism(base.file_pattern)
+  return [
+      ('py_func', base.Copy().Set(normalize_with_py_func=True)),
+      ('native', base.Copy().Set(normalize_with_py_func=False)),
+      ('derive', base.Copy().Set(source_tokenization='derive')),
+      ('cache', base.Copy().Set(source_tokenization='cache')),
+  ]
+
+
+def _ReadLines(file_pattern, num_lines):
+  lines = []
+  for filename in sorted(tf.io.gfile.glob(file_pattern)):
+    with tf.io.gfile.GFile(filename, 'rb') as f:
+      for line in f:
+        lines.append(line.rstrip(b'\n'))
+        if len(lines) >= num_lines:
+          break
+    if len(lines) >= num_lines:
+      break
+  return lines
+
+
+def CheckNormalizersMatch(lines):
+  """Returns the lines the two normalizers disagree on."""
+  with tf.Graph().as_default(), tf.Session() as sess:
+    native = sess.run(input_generator.Normalize(tf.constant(lines)))
+  return [
+      line for line, normalized in zip(lines, native)
+      if input_generator.PyNormalize(line) != normalized
+  ]
+
+
+def DerivedSourceAgreement(params, lines):
+  """Returns the fraction of lines whose derived source ids are exact."""
+  with tf.Graph().as_default():
+    line = tf.placeholder(tf.string, shape=[])
+    src_ids = []
+    for mode in ('tokenize', 'derive'):
+      inp = params.Copy().Set(source_tokenization=mode, name=mode).Instantiate()
+      (ids, paddings, _, _, _, _), _ = inp._ProcessLine(line)
+      src_ids.append(ids[:tf.cast(tf.reduce_sum(1.0 - paddings), tf.int32)])
+    with tf.Session() as sess:
+      num_equal = 0
+      for text in lines:
+        exact, derived = sess.run(src_ids, {line: text})
+        num_equal += int(list(exact) == list(derived))
+  return num_equal / max(1, len(lines))
+
+
+def ExamplesPerSecond(params, steps, warmup_steps):
+  """Times `steps` input batches and returns the examples/sec."""
+  with tf.Graph().as_default():
+    inp = params.Instantiate()
+    batch = inp.GetPreprocessedInputBatch()
+    with tf.Session() as sess:
+      for _ in range(warmup_steps):
+        sess.run(batch.src.ids)
+      num_examples = 0
+      start = time.time()
+      for _ in range(steps):
+        num_examples += sess.run(batch.src.ids).shape[0]
+      return num_examples / (time.time() - start)
+
+
+def main(argv):
+  del argv
+  lines = _ReadLines(_TextFilePattern(), FLAGS.check_lines)
+  mismatches = CheckNormalizersMatch(lines)
+  print('Normalizer check: %d lines, %d mismatches' %
+        (len(lines), len(mismatches)))
+  for line in mismatches[:10]:
+    print('  mismatch: %r' % line)
+
+  settings = _Settings()
+  print('Derived source ids exact on %.1f%% of lines' %
+        (100 * DerivedSourceAgreement(settings[1][1], lines)))
+
+  results = []
+  for name, params in settings:
+    results.append(
+        (name, ExamplesPerSecond(params, FLAGS.steps, FLAGS.warmup_steps)))
+  baseline = results[0][1]
+  print('%-12s %14s %8s' % ('setting', 'examples/sec', 'speedup'))
+  for name, examples_per_sec in results:
+    print('%-12s %14.1f %7.2fx' %
+          (name, examples_per_sec, examples_per_sec / baseline))
+
+
+if __name__ == '__main__':
+  app.run(main)
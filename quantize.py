@@ -0,0 +1,97 @@
+"""
+Seq2Seq推理的int8动态量化。
+
+GRU和Linear的权重量化为int8，激活在运行时动态量化，只支持CPU推理。
+量化后的权重保存在fp32 checkpoint旁边，例如 en2ch-attn-model.pt -> en2ch-attn-model-int8.pt:
+
+    python quantize.py --layers 1
+
+加上 --compare 比较fp32和int8的单句延迟与BLEU，默认用层数脚本留出的最后HOLDOUT个句对
+(不参与训练)中的前 --num_samples 句，也可以用 --data 指定另一个newdata格式的文件:
+
+    python quantize.py --layers 1 --compare --num_samples 500
+"""
+
+import argparse
+import os
+
+import torch
+import torch.nn as nn
+
+import bleu
+import model_loader
+import thread_settings
+
+
+def quantize_model(model):
+    """返回model的int8动态量化副本(GRU和Linear)，model本身不变"""
+    return torch.quantization.quantize_dynamic(model, {nn.GRU, nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_path(model_path):
+    root, ext = os.path.splitext(model_path)
+    return root + "-int8" + ext
+
+
+def export(n_layers, checkpoint=None, output=None):
+    """量化fp32 checkpoint并保存，返回保存路径"""
+    script, model = model_loader.load_model(n_layers, checkpoint, device="cpu")
+    qmodel = quantize_model(model)
+    path = output or quantized_path(checkpoint or script.MODEL_PATH)
+    torch.save(qmodel.state_dict(), path)
+    return path
+
+
+def load_quantized(n_layers, path=None):
+    """返回 (script, qmodel)：先按脚本结构构建量化模型，再加载量化后的权重"""
+    script = model_loader.load_script(n_layers)
+    model = script.model.to("cpu")
+    model.device = torch.device("cpu")
+    qmodel = quantize_model(model.eval())
+    qmodel.load_state_dict(torch.load(path or quantized_path(script.MODEL_PATH), map_location="cpu"))
+    qmodel.eval()
+    return script, qmodel
+
+
+def compare(n_layers, num_samples, data_path=None, checkpoint=None, quantized=None):
+    script, model = model_loader.load_model(n_layers, checkpoint, device="cpu")
+    _, qmodel = load_quantized(n_layers, quantized)
+    pairs = model_loader.eval_pairs(script, data_path)[:num_samples]
+    references = [trg for _, trg in pairs]
+
+    fp32_path = checkpoint or script.MODEL_PATH
+    int8_path = quantized or quantized_path(script.MODEL_PATH)
+    rows = []
+    for name, m, path in [("fp32", model, fp32_path), ("int8", qmodel, int8_path)]:
+        hypotheses, latencies = model_loader.evaluate_model(script, m, pairs)
+        rows.append((name, os.path.getsize(path) / 2**20,
+                     1000 * sum(latencies) / len(latencies),
+                     1000 * model_loader.percentile(latencies, 50),
+                     1000 * model_loader.percentile(latencies, 90),
+                     bleu.corpus_bleu(references, hypotheses)))
+
+    print(f'{len(pairs)} sentences, {n_layers} layer(s), {torch.get_num_threads()} threads')
+    print('%-6s %10s %10s %10s %10s %8s %8s' % ('model', 'size(MB)', 'mean(ms)', 'p50(ms)', 'p90(ms)', 'BLEU', 'speedup'))
+    for name, size, mean, p50, p90, score in rows:
+        print('%-6s %10.1f %10.2f %10.2f %10.2f %8.2f %7.2fx' % (name, size, mean, p50, p90, score, rows[0][2] / mean))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="int8 dynamic quantization for Seq2Seq inference")
+    parser.add_argument("--layers", type=int, default=1, choices=sorted(model_loader.LAYER_SCRIPTS))
+    parser.add_argument("--checkpoint", default=None, help="fp32 checkpoint, 默认为脚本的MODEL_PATH")
+    parser.add_argument("--output", default=None, help="量化checkpoint路径, 默认为 <checkpoint>-int8.pt")
+    parser.add_argument("--compare", action="store_true", help="比较fp32和int8的延迟与BLEU")
+    parser.add_argument("--num_samples", type=int, default=500)
+    parser.add_argument("--data", default=None, help="默认为脚本留出的holdout_pairs")
+    args = parser.parse_args()
+
+    thread_settings.apply("translate")
+    path = export(args.layers, args.checkpoint, args.output)
+    print("Saved int8 checkpoint to", path)
+    if args.compare:
+        compare(args.layers, args.num_samples, args.data, args.checkpoint, path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Reports size and CPU speed of the codelab RNMT variants.
+
+For every variant it lists the parameter count, the training step time on the
+training input and the decode speed on the test input, as a markdown table:
+
+  python rnmt_variant_report.py --output=/tmp/rnmt_variants.md
+"""
+
+import time
+
+from absl import app
+from absl import flags
+import lingvo.compat as tf
+import numpy as np
+
+import codelab
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('train_steps', 20, 'Number of training steps to time.')
+flags.DEFINE_integer('decode_batches', 10, 'Number of test batches to decode.')
+flags.DEFINE_integer('warmup_steps', 2,
+                     'Untimed steps/batches run before timing.')
+flags.DEFINE_string('output', '', 'If set, also write the report here.')
+
+VARIANTS = [
+    codelab.RNMTModel,
+    codelab.RNMTModelSmall,
+    codelab.RNMTModelTiny,
+    codelab.RNMTModelTinyShared,
+]
+
+
+def _TaskParams(variant, input_params):
+  p = variant().Task()
+  p.input = input_params
+  return p
+
+
+def _IsShared(p):
+  return 'shared_emb' in p.decoder and p.decoder.shared_emb is not None
+
+
+def TrainStats(variant, steps, warmup_steps):
+  """Returns (task params, parameter count, seconds per training step)."""
+  p = _TaskParams(variant, variant().Train())
+  with tf.Graph().as_default():
+    task = p.Instantiate()
+    task.FPropDefaultTheta()
+    task.BProp()
+    num_params = sum(
+        int(np.prod(v.shape.as_list())) for v in tf.trainable_variables())
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      for _ in range(warmup_steps):
+        sess.run(task.train_op)
+      start = time.time()
+      for _ in range(steps):
+        sess.run(task.train_op)
+      return p, num_params, (time.time() - start) / steps
+
+
+def DecodeSpeed(variant, num_batches, warmup_steps):
+  """Returns decoded sentences/sec on the test input."""
+  p = _TaskParams(variant, variant().Test())
+  with tf.Graph().as_default():
+    task = p.Instantiate()
+    dec_out = task.Decode(task.input_generator.GetPreprocessedInputBatch())
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      for _ in range(warmup_steps):
+        sess.run(dec_out)
+      num_sentences = 0
+      start = time.time()
+      for _ in range(num_batches):
+        num_sentences += len(sess.run(dec_out)['topk_decoded'])
+      return num_sentences / (time.time() - start)
+
+
+def main(argv):
+  del argv
+  rows = ['| variant | params (M) | shared emb | step time (s) | '
+          'decode (sent/s) |', '|---|---:|:---:|---:|---:|']
+  for variant in VARIANTS:
+    p, num_params, step_time = TrainStats(variant, FLAGS.train_steps,
+                                          FLAGS.warmup_steps)
+    sentences_per_sec = DecodeSpeed(variant, FLAGS.decode_batches,
+                                    FLAGS.warmup_steps)
+    rows.append('| %s | %.1f | %s | %.3f | %.2f |' %
+                (variant.__name__, num_params / 1e6,
+                 'yes' if _IsShared(p) else 'no', step_time, sentences_per_sec))
+  report = '\n'.join(rows) + '\n'
+  print(report)
+  if FLAGS.output:
+    with tf.io.gfile.GFile(FLAGS.output, 'w') as f:
+      f.write(report)
+
+
+if __name__ == '__main__':
+  app.run(main)
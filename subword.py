@@ -0,0 +1,64 @@
+"""
+sentencepiece子词切分(BPE/unigram)，作为字符级切分之外的选项。
+
+子词模型在newdata上训练一次并保存，之后直接加载:
+    newdata-en.unigram8000.model / newdata-en.unigram8000.vocab
+切分结果是piece字符串，由脚本映射成自己的id(和字符级切分共用<pad>/<unk>/<bos>/<eos>)。
+需要 pip install sentencepiece。
+"""
+
+import os
+
+WORD_START = "▁"  # sentencepiece用来表示空格的前缀
+
+
+def _sentencepiece():
+    try:
+        import sentencepiece
+    except ImportError:
+        raise ImportError("Subword tokenization requires sentencepiece: pip install sentencepiece")
+    return sentencepiece
+
+
+def model_path(prefix, vocab_size, model_type="unigram"):
+    return "%s.%s%d.model" % (prefix, model_type, vocab_size)
+
+
+def train(sentences, path, vocab_size, model_type="unigram"):
+    """在sentences上训练子词模型，保存为path(以.model结尾)"""
+    spm = _sentencepiece()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(sentences),
+        model_prefix=path[:-len(".model")],
+        vocab_size=vocab_size,
+        model_type=model_type,
+        character_coverage=1.0,
+        # 语料比较小时vocab_size可能达不到，不报错
+        hard_vocab_limit=False,
+        # 特殊token由脚本的basic_dict管理
+        bos_id=-1, eos_id=-1, pad_id=-1, unk_id=0)
+
+
+def detokenize(pieces):
+    return "".join(pieces).replace(WORD_START, " ").strip()
+
+
+class SubwordTokenizer:
+    def __init__(self, path):
+        self.path = path
+        self.sp = _sentencepiece().SentencePieceProcessor(model_file=path)
+
+    def encode(self, line):
+        return self.sp.encode(line, out_type=str)
+
+    def encode_batch(self, lines):
+        # 一次传入整个列表，由sentencepiece在C++里批量切分
+        return self.sp.encode(list(lines), out_type=str)
+
+
+def get_tokenizer(sentences, prefix, vocab_size, model_type="unigram"):
+    """加载 prefix 对应的子词模型，不存在时先在sentences上训练"""
+    path = model_path(prefix, vocab_size, model_type)
+    if not os.path.exists(path):
+        train(sentences, path, vocab_size, model_type)
+    return SubwordTokenizer(path)
@@ -0,0 +1,88 @@
+"""
+比较字符级切分和子词切分：每句话的encoder/decoder步数、词表大小和训练一个step的时间。
+
+    python subword_benchmark.py --layers 1 --vocab_sizes 4000,8000 --steps 20 --output subword.md
+
+每种设置都用同样的超参数(来自对应的层数脚本)新建一个Seq2Seq，在newdata开头的句子上
+预热 --warmup 个batch后训练 --steps 个batch，报告平均每个step的时间。两种切分的batch都是
+--batch_size 句，一个epoch的step数相同，所以step时间之比就是epoch时间之比。
+"""
+
+import argparse
+
+import torch.optim as optim
+
+import model_loader
+import subword
+
+COLUMNS = [("setting", "l", "%s"), ("src vocab", "r", "%d"), ("trg vocab", "r", "%d"), ("enc steps", "r", "%.1f"),
+           ("dec steps", "r", "%.1f"), ("step (s)", "r", "%.3f"), ("speedup", "r", "%.2fx")]
+
+
+def build_vocab(token_lists, basic_dict):
+    """和脚本里一样：排序后的token接在basic_dict之后"""
+    vocab = sorted(set(token for line in token_lists for token in line))
+    token2id = {token: i+len(basic_dict) for i, token in enumerate(vocab)}
+    token2id.update(basic_dict)
+    return token2id
+
+
+def tokenize(setting, en_data, ch_data, model_type):
+    if setting == "char":
+        return [list(line) for line in en_data], [list(line) for line in ch_data]
+    vocab_size = int(setting)
+    en_tokenizer = subword.get_tokenizer(en_data, "newdata-en", vocab_size, model_type)
+    ch_tokenizer = subword.get_tokenizer(ch_data, "newdata-ch", vocab_size, model_type)
+    return en_tokenizer.encode_batch(en_data), ch_tokenizer.encode_batch(ch_data)
+
+
+def step_seconds(script, en_tokens, ch_tokens, batch_size, steps, warmup):
+    en2id = build_vocab(en_tokens, script.basic_dict)
+    ch2id = build_vocab(ch_tokens, script.basic_dict)
+    en_num_data = [[en2id[t] for t in line] + [en2id["<eos>"]] for line in en_tokens]
+    ch_num_data = [[ch2id[t] for t in line] + [ch2id["<eos>"]] for line in ch_tokens]
+
+    enc = script.Encoder(len(en2id), script.ENC_EMB_DIM, script.HID_DIM, script.N_LAYERS,
+                         script.ENC_DROPOUT, script.bidirectional)
+    dec = script.AttnDecoder(len(ch2id), script.DEC_EMB_DIM, script.HID_DIM, script.N_LAYERS,
+                             script.DEC_DROPOUT, script.bidirectional, script.attn_method)
+    model = script.Seq2Seq(enc, dec, script.device, basic_dict=script.basic_dict).to(script.device)
+    optimizer = optim.Adam(model.parameters(), lr=script.LEARNING_RATE)
+    seconds = model_loader.train_step_seconds(script, model, optimizer, steps, warmup, batch_size,
+                                              data=(en_num_data, ch_num_data))
+    return seconds, len(en2id), len(ch2id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="character vs subword tokenization benchmark")
+    parser.add_argument("--layers", type=int, default=1, choices=sorted(model_loader.LAYER_SCRIPTS))
+    parser.add_argument("--vocab_sizes", default="4000,8000")
+    parser.add_argument("--model_type", default="unigram", choices=["unigram", "bpe"])
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=20, help="计时的训练step数")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", default=None, help="把markdown表格也写到这个文件")
+    args = parser.parse_args()
+
+    script = model_loader.load_script(args.layers)
+    pairs = model_loader.load_pairs()
+    en_data = [src for src, _ in pairs]
+    ch_data = [trg for _, trg in pairs]
+
+    rows = []
+    for setting in ["char"] + args.vocab_sizes.split(","):
+        # 子词模型在整个newdata上训练，步数也在整个newdata上统计
+        en_tokens, ch_tokens = tokenize(setting, en_data, ch_data, args.model_type)
+        src_steps = sum(len(line) + 1 for line in en_tokens) / len(en_tokens)
+        trg_steps = sum(len(line) + 1 for line in ch_tokens) / len(ch_tokens)
+        seconds, src_vocab, trg_vocab = step_seconds(
+            script, en_tokens, ch_tokens, args.batch_size, args.steps, args.warmup)
+        rows.append((setting, src_vocab, trg_vocab, src_steps, trg_steps, seconds))
+
+    print(f'{args.steps} steps, {args.layers} layer(s), batch size {args.batch_size}')
+    rows = [row + (rows[0][5] / row[5],) for row in rows]
+    model_loader.write_report(model_loader.markdown_table(COLUMNS, rows), args.output)
+
+
+if __name__ == "__main__":
+    main()
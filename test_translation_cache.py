@@ -0,0 +1,92 @@
+"""
+TranslationCache和cached_translate的单元测试(不需要torch):
+
+    python -m pytest test_translation_cache.py
+"""
+
+import sys
+import types
+import unittest
+from unittest import mock
+
+from translation_cache import TranslationCache, cached_translate
+
+
+class TranslationCacheTest(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = TranslationCache(version="v1")
+        self.assertIsNone(cache.get((5, 6), "v1"))
+        cache.put((5, 6), "v1", "Hallo")
+        self.assertEqual(cache.get((5, 6), "v1"), "Hallo")
+        metrics = cache.metrics()
+        self.assertEqual((metrics["hits"], metrics["misses"], metrics["size"]), (1, 1, 1))
+
+    def test_lru_eviction(self):
+        cache = TranslationCache(max_size=2, version="v1")
+        cache.put((1,), "v1", "a")
+        cache.put((2,), "v1", "b")
+        cache.get((1,), "v1")  # (2,) 变成最久未使用的
+        cache.put((3,), "v1", "c")
+        self.assertIsNone(cache.get((2,), "v1"))
+        self.assertEqual(cache.get((1,), "v1"), "a")
+        self.assertEqual(cache.get((3,), "v1"), "c")
+        self.assertEqual(cache.metrics()["evictions"], 1)
+
+    def test_ttl_expiry(self):
+        cache = TranslationCache(ttl=10, version="v1")
+        with mock.patch("translation_cache.time.monotonic", return_value=100.):
+            cache.put((1,), "v1", "a")
+        with mock.patch("translation_cache.time.monotonic", return_value=105.):
+            self.assertEqual(cache.get((1,), "v1"), "a")
+        with mock.patch("translation_cache.time.monotonic", return_value=111.):
+            self.assertIsNone(cache.get((1,), "v1"))
+        self.assertEqual(cache.metrics()["expirations"], 1)
+
+    def test_reset_clears_and_switches_version(self):
+        cache = TranslationCache(version="v1")
+        cache.put((1,), "v1", "old")
+        cache.reset("v2")
+        self.assertEqual(cache.version, "v2")
+        self.assertIsNone(cache.get((1,), "v2"))
+        self.assertIsNone(cache.get((1,), "v1"))
+        self.assertEqual(cache.metrics()["invalidations"], 1)
+
+    def test_stale_put_after_reset_is_ignored(self):
+        # reload之前开始的batch在reset之后才用旧版本put
+        cache = TranslationCache(version="v1")
+        cache.reset("v2")
+        cache.put((1,), "v2", "new")
+        cache.put((1,), "v1", "old")
+        cache.put((2,), "v1", "old")
+        self.assertEqual(cache.version, "v2")
+        self.assertEqual(cache.get((1,), "v2"), "new")
+        self.assertIsNone(cache.get((2,), "v2"))
+
+    def test_lookup_with_other_version_keeps_entries(self):
+        cache = TranslationCache(version="v2")
+        cache.put((1,), "v2", "new")
+        self.assertIsNone(cache.get((1,), "v1"))
+        self.assertEqual(cache.version, "v2")
+        self.assertEqual(cache.get((1,), "v2"), "new")
+
+    def test_cached_translate_resets_on_new_model_version(self):
+        # 代替model_loader(它会import torch)，id就是字符的编码
+        fake_loader = types.SimpleNamespace(
+            normalize_source=lambda sentence: sentence,
+            source_ids=lambda script, sentence: [ord(c) for c in sentence],
+            encode_source=lambda script, sentence, device=None: sentence)
+        script = types.SimpleNamespace(id2ch=None, translate=lambda model, sample, id2ch: model.version + ":" + sample)
+        model = types.SimpleNamespace(version="v1", device=None)
+        cache = TranslationCache(version="v1")
+        with mock.patch.dict(sys.modules, {"model_loader": fake_loader}):
+            self.assertEqual(cached_translate(cache, script, model, "Hi."), "v1:Hi.")
+            model.version = "v2"  # load_checkpoint换了checkpoint，但没有reset缓存
+            self.assertEqual(cached_translate(cache, script, model, "Hi."), "v2:Hi.")
+            self.assertEqual(cached_translate(cache, script, model, "Hi."), "v2:Hi.")
+        self.assertEqual(cache.version, "v2")
+        metrics = cache.metrics()
+        self.assertEqual((metrics["hits"], metrics["invalidations"], metrics["size"]), (1, 1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
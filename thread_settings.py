@@ -0,0 +1,66 @@
+"""
+按主机和任务保存/应用torch的线程数(intra-op和inter-op)。
+
+autotune_threads.py 把每台机器上测出的最优设置写进 thread_settings.json:
+    {"<hostname>": {"train/jobs=1": {"num_threads": 4, "interop_threads": 1, ...}, ...}}
+入口脚本启动时调用 apply(workload, jobs)，本机没有测过时保持torch的默认值。
+环境变量 SEQ2SEQ_THREADS="num_threads,interop_threads" 优先于保存的设置。
+"""
+
+import json
+import os
+import socket
+
+import torch
+
+SETTINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thread_settings.json")
+ENV_OVERRIDE = "SEQ2SEQ_THREADS"
+
+
+def host_key():
+    return socket.gethostname()
+
+
+def workload_key(workload, jobs=1):
+    # 同一台机器上同时跑jobs个进程时，每个进程的最优线程数不同
+    return "%s/jobs=%d" % (workload, jobs)
+
+
+def load_all(path=SETTINGS_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load(workload, jobs=1, path=SETTINGS_FILE):
+    """返回本机这个任务保存的设置，没有时返回None"""
+    return load_all(path).get(host_key(), {}).get(workload_key(workload, jobs))
+
+
+def save(workload, jobs, settings, path=SETTINGS_FILE):
+    all_settings = load_all(path)
+    all_settings.setdefault(host_key(), {})[workload_key(workload, jobs)] = settings
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(all_settings, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def apply(workload, jobs=1, path=SETTINGS_FILE):
+    """设置torch线程数，返回 (num_threads, interop_threads)；没有可用设置时返回None"""
+    override = os.environ.get(ENV_OVERRIDE)
+    if override:
+        num_threads, interop_threads = map(int, override.split(","))
+    else:
+        settings = load(workload, jobs, path)
+        if settings is None:
+            return None
+        num_threads, interop_threads = settings["num_threads"], settings["interop_threads"]
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # inter-op线程池已经启动后不能再修改
+        pass
+    return num_threads, interop_threads
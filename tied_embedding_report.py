@@ -0,0 +1,63 @@
+"""
+比较AttnDecoder的embedding和输出层共用权重(tie_embeddings)前后的参数量、内存和训练速度。
+
+    python tied_embedding_report.py --layers 1,2,3 --steps 10 --output tied.md
+
+对每个层数脚本的配置分别新建不共享/共享权重的Seq2Seq，报告:
+    参数量；参数+梯度+Adam状态占用的内存(fp32，每个参数16字节)；训练 --steps 步的平均时间
+"""
+
+import argparse
+
+import torch.optim as optim
+
+import model_loader
+
+BYTES_PER_PARAM = 4 * 4  # 参数、梯度和Adam的两个状态，都是fp32
+COLUMNS = [("layers", "r", "%d"), ("tied", "c", "%s"), ("params (M)", "r", "%.2f"),
+           ("params+grads+Adam (MB)", "r", "%.0f"), ("step time (s)", "r", "%.3f"),
+           ("saved params", "r", "%.1f%%"), ("speedup", "r", "%.2fx")]
+
+
+def build_model(script, tie_embeddings):
+    enc = script.Encoder(script.INPUT_DIM, script.ENC_EMB_DIM, script.HID_DIM, script.N_LAYERS,
+                         script.ENC_DROPOUT, script.bidirectional)
+    dec = script.AttnDecoder(script.OUTPUT_DIM, script.DEC_EMB_DIM, script.HID_DIM, script.N_LAYERS,
+                             script.DEC_DROPOUT, script.bidirectional, script.attn_method,
+                             tie_embeddings=tie_embeddings)
+    return script.Seq2Seq(enc, dec, script.device, basic_dict=script.basic_dict).to(script.device)
+
+
+def step_seconds(script, model, steps):
+    optimizer = optim.Adam(model.parameters(), lr=script.LEARNING_RATE)
+    return model_loader.train_step_seconds(script, model, optimizer, steps, warmup=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tied decoder embedding report")
+    parser.add_argument("--layers", default="1,2,3")
+    parser.add_argument("--steps", type=int, default=10, help="计时的训练step数")
+    parser.add_argument("--output", default=None, help="把markdown表格也写到这个文件")
+    args = parser.parse_args()
+
+    rows = []
+    for layers in map(int, args.layers.split(',')):
+        script = model_loader.load_script(layers)
+        results = []
+        for tie_embeddings in (False, True):
+            model = build_model(script, tie_embeddings)
+            # parameters()对共享的权重只返回一次
+            num_params = sum(p.numel() for p in model.parameters())
+            results.append((tie_embeddings, num_params, step_seconds(script, model, args.steps)))
+        base_params, base_seconds = results[0][1], results[0][2]
+        for tie_embeddings, num_params, seconds in results:
+            rows.append((layers, 'yes' if tie_embeddings else 'no', num_params / 1e6,
+                         num_params * BYTES_PER_PARAM / 2**20, seconds,
+                         100 * (base_params - num_params) / base_params, base_seconds / seconds))
+            print(model_loader.markdown_row(COLUMNS, rows[-1]))
+    print()
+    model_loader.write_report(model_loader.markdown_table(COLUMNS, rows), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+翻译结果的LRU/TTL缓存。
+
+key是规范化后的源句id序列(未登录字符都映射为<unk>，所以只差未登录字符或空白的句子共享一条缓存)，
+同时记录模型版本(model.version，见 model_loader.load_checkpoint)：
+重新加载checkpoint后调用 reset(新版本) 清空缓存；版本不是当前版本的 get() 一律未命中，
+put() 直接忽略，所以reload之前开始解码的batch不会把旧checkpoint的翻译写进来。
+"""
+
+import collections
+import threading
+import time
+
+
+class TranslationCache:
+    def __init__(self, max_size=10000, ttl=None, version=None):
+        """
+        max_size: 最多缓存的句子数；ttl: 过期时间(秒)，None表示不过期；
+        version: 当前的模型版本，之后只由reset()改变
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (translation, 写入时间)
+        self.version = version
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def reset(self, version):
+        """模型换成version(重新加载了checkpoint)：清空缓存，之后只接受这个版本"""
+        with self.lock:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        """返回缓存的翻译，没有或者version不是当前版本时返回None"""
+        with self.lock:
+            entry = self.entries.get(key) if version == self.version else None
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, version, translation):
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[key] = (translation, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+def cache_key(script, sentence):
+    # 在这里import，TranslationCache本身不依赖torch
+    import model_loader
+    return tuple(model_loader.source_ids(script, model_loader.normalize_source(sentence)))
+
+
+def cached_translate(cache, script, model, sentence):
+    """先查缓存，未命中再用 translate() 翻译规范化后的句子；model重新加载过checkpoint时先清空缓存"""
+    import model_loader
+    if cache.version != model.version:
+        cache.reset(model.version)
+    key = cache_key(script, sentence)
+    translation = cache.get(key, model.version)
+    if translation is None:
+        sample = model_loader.encode_source(script, model_loader.normalize_source(sentence), device=model.device)
+        translation = script.translate(model, sample, script.id2ch)
+        cache.put(key, model.version, translation)
+    return translation
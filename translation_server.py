@@ -0,0 +1,297 @@
+"""
+本地翻译服务：checkpoint只加载一次，把并发请求攒成动态micro-batch一起解码。
+
+    python translation_server.py --layers 1 --port 8000
+    python translation_server.py --layers 1 --unix_socket /tmp/translate.sock
+
+    curl -s localhost:8000/translate -d '{"text": "A man in a blue shirt."}'
+    curl -s localhost:8000/translate -d '{"texts": ["Hi.", "Run!"]}'
+    curl -s localhost:8000/metrics
+    curl -s localhost:8000/reload -d '{}'
+    curl -s localhost:8000/reload -d '{"checkpoint": "en2ch-attn-model-v2.pt"}'
+    curl -s --unix-socket /tmp/translate.sock http://localhost/metrics
+
+一个batch在攒满 --max_batch_size 句或者第一句等了 --max_wait_ms 之后开始解码，
+/metrics 返回请求延迟的百分位数、当前和最大队列长度以及平均batch大小。
+
+翻译结果缓存在 TranslationCache 里(--cache_size 0 关闭)，命中的句子不进入队列。
+/reload 重新加载checkpoint(默认为启动时的路径)并清空缓存，
+只能加载启动时的路径和 --reload_checkpoint 列出的文件。
+"""
+
+import argparse
+import collections
+import json
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+import model_loader
+import thread_settings
+from translation_cache import TranslationCache, cache_key
+
+
+class LatencyStats:
+    """最近 window 个请求的延迟(毫秒)"""
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def add(self, latency_ms):
+        with self.lock:
+            self.latencies.append(latency_ms)
+
+    def percentiles(self, qs=(50, 90, 99)):
+        with self.lock:
+            values = sorted(self.latencies)
+        if not values:
+            return {f"p{q}": None for q in qs}
+        return {f"p{q}": values[min(len(values) - 1, int(q / 100 * len(values)))] for q in qs}
+
+
+class MicroBatcher:
+    """
+    收集并发提交的句子，由单独的线程按batch解码。
+    submit() 返回Future，结果为这句话的翻译。
+    """
+    def __init__(self, script, model, max_batch_size=32, max_wait_ms=5, cache=None):
+        self.script = script
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.cache = cache
+        # 解码和重新加载checkpoint互斥
+        self.model_lock = threading.Lock()
+
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.max_queue_depth = 0
+        self.num_batches = 0
+        self.num_sentences = 0
+        self.latency = LatencyStats()
+        self.running = True
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, sentence):
+        future = Future()
+        start = time.perf_counter()
+        sentence = model_loader.normalize_source(sentence)
+        key = None
+        if self.cache is not None:
+            key = cache_key(self.script, sentence)
+            translation = self.cache.get(key, self.model.version)
+            if translation is not None:
+                self.latency.add(1000 * (time.perf_counter() - start))
+                future.set_result(translation)
+                return future
+        with self.cond:
+            self.queue.append((sentence, key, future, start))
+            self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+            self.cond.notify()
+        return future
+
+    def _next_batch(self):
+        with self.cond:
+            while self.running and not self.queue:
+                self.cond.wait()
+            # 从第一句到达开始计时，最多等max_wait或者攒满一个batch
+            deadline = self.queue[0][3] + self.max_wait if self.queue else 0
+            while self.running and len(self.queue) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return [self.queue.popleft() for _ in range(min(self.max_batch_size, len(self.queue)))]
+
+    def _run(self):
+        while self.running:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            sentences = [sentence for sentence, _, _, _ in batch]
+            try:
+                with self.model_lock:
+                    version = self.model.version
+                    sample = model_loader.encode_batch(self.script, sentences, device=self.model.device)
+                    translations = self.script.translate_batch(self.model, sample, self.script.id2ch)
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            for (_, key, future, start), translation in zip(batch, translations):
+                if self.cache is not None:
+                    self.cache.put(key, version, translation)
+                self.latency.add(1000 * (now - start))
+                future.set_result(translation)
+            self.num_batches += 1
+            self.num_sentences += len(batch)
+
+    def reload(self, checkpoint):
+        """重新加载checkpoint，返回新的模型版本"""
+        with self.model_lock:
+            model_loader.load_checkpoint(self.model, checkpoint)
+            # 在model_lock里reset，之后开始的batch都用新版本；之前的batch用旧版本put，会被忽略
+            if self.cache is not None:
+                self.cache.reset(self.model.version)
+            return self.model.version
+
+    def metrics(self):
+        with self.cond:
+            queue_depth = len(self.queue)
+        metrics = {
+            "model_version": self.model.version,
+            "queue_depth": queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "batches": self.num_batches,
+            "sentences": self.num_sentences,
+            "mean_batch_size": self.num_sentences / max(1, self.num_batches),
+            "latency_ms": self.latency.percentiles(),
+        }
+        if self.cache is not None:
+            metrics["cache"] = self.cache.metrics()
+        # 包括因达到长度上限(没有输出<eos>)而结束的句子数
+        metrics["decode"] = dict(self.model.decode_stats)
+        return metrics
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.worker.join()
+
+
+class TranslationHandler(BaseHTTPRequestHandler):
+    # 由make_server设置，checkpoints[0]是启动时的路径，/reload只能加载这些文件
+    batcher = None
+    checkpoints = ()
+    timeout_s = 30
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_json(200, self.batcher.metrics())
+        elif self.path == "/healthz":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path == "/reload":
+            self._reload()
+            return
+        if self.path != "/translate":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            texts = request["texts"] if "texts" in request else [request["text"]]
+            # "texts": "abc" 不能当成三句话逐字翻译
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                raise TypeError(texts)
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {"error": 'expected {"text": str} or {"texts": [str, ...]}'})
+            return
+        futures = [self.batcher.submit(text) for text in texts]
+        try:
+            translations = [future.result(self.timeout_s) for future in futures]
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+        if "texts" in request:
+            self._send_json(200, {"translations": translations})
+        else:
+            self._send_json(200, {"translation": translations[0]})
+
+    def _reload(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            checkpoint = request.get("checkpoint") or self.checkpoints[0]
+            if not isinstance(checkpoint, str):
+                raise TypeError(checkpoint)
+        except (ValueError, AttributeError, TypeError):
+            self._send_json(400, {"error": 'expected {} or {"checkpoint": str}'})
+            return
+        allowed = {os.path.abspath(path): path for path in self.checkpoints}
+        if os.path.abspath(checkpoint) not in allowed:
+            self._send_json(403, {"error": "checkpoint not allowed", "allowed": list(self.checkpoints)})
+            return
+        try:
+            version = self.batcher.reload(allowed[os.path.abspath(checkpoint)])
+        except Exception as e:
+            self._send_json(500, {"error": repr(e)})
+            return
+        self._send_json(200, {"model_version": version})
+
+    def address_string(self):
+        # unix socket的client_address不是(host, port)
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(batcher, checkpoints, host="127.0.0.1", port=8000, unix_socket=None):
+    handler = type("Handler", (TranslationHandler,), {"batcher": batcher, "checkpoints": tuple(checkpoints)})
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seq2Seq translation server with dynamic batching")
+    parser.add_argument("--layers", type=int, default=1, choices=sorted(model_loader.LAYER_SCRIPTS))
+    parser.add_argument("--checkpoint", default=None, help="默认为脚本的MODEL_PATH")
+    parser.add_argument("--reload_checkpoint", action="append", default=[],
+                        help="/reload 还可以加载的checkpoint，可以重复")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", default=None, help="监听unix socket而不是TCP端口")
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch.set_num_threads, 默认使用autotune_threads.py保存的配置")
+    parser.add_argument("--cache_size", type=int, default=10000, help="缓存的句子数，0表示不缓存")
+    parser.add_argument("--cache_ttl", type=float, default=None, help="缓存过期时间(秒)")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    else:
+        thread_settings.apply("translate")
+    script, model = model_loader.load_model(args.layers, args.checkpoint)
+    cache = TranslationCache(args.cache_size, args.cache_ttl, model.version) if args.cache_size > 0 else None
+    batcher = MicroBatcher(script, model, args.max_batch_size, args.max_wait_ms, cache)
+    checkpoints = [args.checkpoint or script.MODEL_PATH] + args.reload_checkpoint
+    server = make_server(batcher, checkpoints, args.host, args.port, args.unix_socket)
+    print("Serving on", args.unix_socket or f"http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == "__main__":
+    main()